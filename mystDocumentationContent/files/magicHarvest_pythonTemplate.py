@@ -8,62 +8,279 @@ extension for LANDIS-II.
 
 It contains a template for using Magic Harvest easily in different landscapes
 
+To avoid starting Python and re-reading the static data of the landscape
+(stands, management units, neighbors) at every timestep, you can launch a
+"warm worker" from the folder of your LANDIS-II scenario before the simulation :
+
+    python magicHarvest_pythonTemplate.py serve
+
+The command called by Magic Harvest (python magicHarvest_pythonTemplate.py {timestep})
+will then just send the timestep to the worker and wait for it to write the
+outputs. If no worker is running, the script runs normally. To stop the worker :
+
+    python magicHarvest_pythonTemplate.py stop
+
+(The warm worker uses a Unix socket and os.fork, so it's not available on Windows.)
+
 """
 
 #%% IMPORTING MODULES
 
-import sys, os, csv, json
+import sys, os, csv, json, socket
+
+#%% WARM WORKER CLIENT
+
+# Path of the socket used to communicate with the warm worker (see above)
+warmWorkerSocketPath = "./input/disturbances/harvesting/tempMagicHarvest/magicHarvestWorker.sock"
+# Line sent by the worker at the end of a request, followed by the exit code
+warmWorkerExitMarker = "MAGIC_HARVEST_WORKER_EXIT_CODE"
+
+def sendRequestToWarmWorker(socketPath, request):
+    """Sends a request (a timestep, or "stop") to the warm worker and prints
+    what the worker prints while dealing with it.
+    Returns the exit code of the worker for this request, or None if
+    there is no worker listening at socketPath.
+    This is done before importing the heavy modules, as this is what
+    we want to avoid by using the worker."""
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(socketPath):
+        return(None)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketPath)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # The socket file was left by a worker that is not running anymore
+        client.close()
+        return(None)
+    exitCode = 1 # If the worker dies without telling us, it's an error
+    with client:
+        # We send the folder we're in, as the paths of the script are relative to it
+        client.sendall((str(request) + "\t" + os.getcwd() + "\n").encode())
+        for line in client.makefile("rb"):
+            if line.startswith(warmWorkerExitMarker.encode()):
+                exitCode = int(line.split()[1])
+            else:
+                sys.stdout.buffer.write(line)
+                sys.stdout.flush()
+    return(exitCode)
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] != "serve":
+    workerExitCode = sendRequestToWarmWorker(warmWorkerSocketPath, sys.argv[1])
+    if workerExitCode is not None:
+        sys.exit(workerExitCode)
+    elif sys.argv[1] == "stop":
+        print("No Magic Harvest warm worker is running.")
+        sys.exit(0)
+
+#%% IMPORTING HEAVY MODULES
+
 import pandas as pd
 from osgeo import gdal
+from osgeo import gdal_array
 from osgeo import ogr
 import numpy as np
+from scipy import sparse
+from scipy import optimize
 from tqdm import tqdm
-import statistics
-from collections import Counter
 import random
+import re
+import heapq
+from collections import OrderedDict, deque
 import shutil
 import pickle
+import hashlib
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 #%% FUNCTIONS
 
-def getRasterData(path):
+# Data types to which the values of the rasters are narrowed when reading them
+# (see getRasterData). This divides the memory used by the rasters by 2 to 4.
+# Change them if the values of your rasters don't fit in these types.
+rasterDataTypes = {"stands": np.int32,
+                   "managementUnits": np.int32,
+                   "ages": np.int16,
+                   "mapcodes": np.int32,
+                   "severities": np.int16}
+
+def getRasterData(path, dataType = None, outputBuffer = None):
+    """Reads the first band of a raster. The array made by GDAL is returned
+    without copying it, and is read-only (use .copy() if you need to edit it).
+    If dataType is given (e.g. np.int32, see rasterDataTypes), GDAL converts
+    the values to this type while reading them.
+    If outputBuffer is given (a numpy array of the size of the raster), the
+    values are read into it instead of into a new array, and it's returned."""
     raster = gdal.Open(path)
-    rasterData = raster.GetRasterBand(1)
-    rasterData = rasterData.ReadAsArray()
-    return(np.array(rasterData))
+    band = raster.GetRasterBand(1)
+    if outputBuffer is not None:
+        return(band.ReadAsArray(buf_obj = outputBuffer))
+    if dataType is not None:
+        rasterData = band.ReadAsArray(buf_type = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dataType)))
+    else:
+        rasterData = band.ReadAsArray()
+    rasterData.setflags(write = False)
+    return(rasterData)
 
 def getRasterDataAsList(path):
     return(getRasterData(path).tolist())
 
-def writeNewRasterData(rasterDataArray, pathOfTemplateRaster, pathOfOutput):
-    # Saves a raster in int16 with a nodata value of 0
+def stripRowsOfRaster(numberOfColumns, blockRows, maximumPixelsPerStrip):
+    """Returns the height of the strips used to read a raster by blocks
+    (see iterateRasterBlocks) : a multiple of the height of its blocks, with
+    around maximumPixelsPerStrip pixels per strip."""
+    return(max(blockRows, (maximumPixelsPerStrip // max(numberOfColumns, 1)) // blockRows * blockRows))
+
+def iterateRasterBlocks(path, overlapRows = 0, maximumPixelsPerStrip = 2**24, dataType = None, stripRows = None):
+    """Reads a raster by horizontal strips of whole rows, so that the whole
+    raster never has to be in memory. The height of the strips is a multiple
+    of the height of the blocks of the raster (so that GDAL reads each block
+    only once), with around maximumPixelsPerStrip pixels per strip.
+    Yields (first row of the strip, number of rows of the strip, strip data).
+    The strip data also contains the overlapRows rows following the strip
+    (if any), which is needed to compare pixels with the ones below them.
+    If dataType is given, GDAL converts the values to this type (see getRasterData).
+    If stripRows is given, it is used as the height of the strips (e.g. to
+    read another raster by the same strips, see iterateStandBlocks)."""
+    if dataType is not None:
+        dataType = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dataType))
+    raster = gdal.Open(path)
+    band = raster.GetRasterBand(1)
+    numberOfRows = raster.RasterYSize
+    numberOfColumns = raster.RasterXSize
+    if stripRows is None:
+        stripRows = stripRowsOfRaster(numberOfColumns, band.GetBlockSize()[1], maximumPixelsPerStrip)
+    for firstRow in range(0, numberOfRows, stripRows):
+        numberOfStripRows = min(stripRows, numberOfRows - firstRow)
+        numberOfRowsToRead = min(numberOfStripRows + overlapRows, numberOfRows - firstRow)
+        yield (firstRow, numberOfStripRows, band.ReadAsArray(0, firstRow, numberOfColumns, numberOfRowsToRead,
+                                                             buf_type = dataType))
+
+def getRasterValuesAtPixels(path, flatIndices, dataType = None):
+    """Returns the values of a raster for a list of pixels given by their flat
+    indices (as in array.ravel()), reading the raster strip by strip.
+    WARNING : this makes arrays as big as the list of pixels; to compute
+    statistics per stand, iterateStandBlocks keeps the memory used bounded.
+    If dataType is given, GDAL converts the values to this type (see getRasterData)."""
+    numberOfColumns = getRasterProfile(path).columns
+    order = np.argsort(flatIndices, kind = "stable")
+    sortedFlatIndices = flatIndices[order]
+    values = None
+    for firstRow, numberOfStripRows, stripData in iterateRasterBlocks(path, dataType = dataType):
+        if values is None:
+            values = np.empty(len(flatIndices), dtype = stripData.dtype)
+        start = np.searchsorted(sortedFlatIndices, firstRow * numberOfColumns)
+        end = np.searchsorted(sortedFlatIndices, (firstRow + numberOfStripRows) * numberOfColumns)
+        values[order[start:end]] = stripData.ravel()[sortedFlatIndices[start:end] - firstRow * numberOfColumns]
+    return(values)
+
+def loadInputsInParallel(dictOfReads):
+    """Starts reading several inputs at the same time, on a pool of threads.
+    dictOfReads associates a name to a tuple (function, arguments...), e.g.
+    {"stands": (getRasterData, "stands.tif")}. Reading a raster with GDAL or a
+    csv with pandas lets the other threads run, so the inputs are read in
+    about the time needed to read the slowest one.
+    Returns a dictionnary associating each name to a Future : use
+    .result() on it to wait for the input and get it."""
+    pool = ThreadPoolExecutor(max_workers = max(len(dictOfReads), 1))
+    futures = dict()
+    for name in dictOfReads:
+        futures[name] = pool.submit(*dictOfReads[name])
+    # The pool ends by itself once all of the reads are done
+    pool.shutdown(wait = False)
+    return(futures)
+
+class RasterStore:
+    """Keeps the rasters already read in memory, so that a raster used by
+    several functions (like the stands raster) is only read once.
+    A raster is read again if its file was modified since.
+    If maximumBytes is given, the least recently used rasters are removed
+    from memory when the rasters kept take more than maximumBytes."""
+    def __init__(self, maximumBytes = None):
+        self.maximumBytes = maximumBytes
+        # (Path, data type) -> (modification time, array), from least to most recently used
+        self._rasters = OrderedDict()
+        # The store can be used by several threads (see loadInputsInParallel)
+        self._lock = threading.Lock()
+    
+    def get(self, path, dataType = None):
+        """Returns the data of the raster at the given path (read-only, see
+        getRasterData), with its values converted to dataType if given."""
+        key = (os.path.abspath(path), dataType)
+        modificationTime = os.path.getmtime(path)
+        with self._lock:
+            if key in self._rasters and self._rasters[key][0] == modificationTime:
+                self._rasters.move_to_end(key)
+                return(self._rasters[key][1])
+        # The lock is not kept while reading, so that other rasters can be read at the same time
+        rasterData = getRasterData(path, dataType)
+        with self._lock:
+            self._rasters[key] = (modificationTime, rasterData)
+            self._rasters.move_to_end(key)
+            if self.maximumBytes is not None:
+                # We always keep the raster we just read
+                while len(self._rasters) > 1 and sum(raster[1].nbytes for raster in self._rasters.values()) > self.maximumBytes:
+                    self._rasters.popitem(last = False)
+        return(rasterData)
+    
+    def remove(self, path, dataType = None):
+        """Removes a raster from memory (e.g. once it has been turned into
+        smaller structures)."""
+        with self._lock:
+            self._rasters.pop((os.path.abspath(path), dataType), None)
+    
+    def clear(self):
+        with self._lock:
+            self._rasters.clear()
+
+# Rasters read by the functions below (see RasterStore)
+rasterStore = RasterStore()
+
+class RasterProfile:
+    """Metadata of a raster (size, geotransform, projection, nodata value,
+    block size and data type), read without reading the pixels of the raster."""
+    def __init__(self, path):
+        raster = gdal.Open(path)
+        band = raster.GetRasterBand(1)
+        self.rows = raster.RasterYSize
+        self.columns = raster.RasterXSize
+        self.geoTransform = raster.GetGeoTransform()
+        self.projection = raster.GetProjection()
+        self.noDataValue = band.GetNoDataValue()
+        self.blockSize = band.GetBlockSize()
+        self.dataType = band.DataType
+        raster = None
+
+# Profiles already read, by path of raster (see getRasterProfile)
+rasterProfiles = dict()
+
+def getRasterProfile(path):
+    """Returns the RasterProfile of a raster, reading it only the first time."""
+    if path not in rasterProfiles:
+        rasterProfiles[path] = RasterProfile(path)
+    return(rasterProfiles[path])
+
+def writeRasterData(rasterDataArray, pathOfTemplateRaster, pathOfOutput, dataType = gdal.GDT_Int16, noDataValue = 0):
+    # Saves a raster with the given GDAL data type and nodata value, with the
+    # same size, geotransform and projection as the template raster
     # Inspired from https://gis.stackexchange.com/questions/164853/reading-modifying-and-writing-a-geotiff-with-gdal-in-python
-    # Loading template raster
-    template = gdal.Open(pathOfTemplateRaster)
+    # Loading template raster profile (its pixels are not read)
+    template = getRasterProfile(pathOfTemplateRaster)
     driver = gdal.GetDriverByName("GTiff")
-    [rows, cols] = template.GetRasterBand(1).ReadAsArray().shape
-    outputRaster = driver.Create(pathOfOutput, cols, rows, 1, gdal.GDT_Int16)
-    outputRaster.SetGeoTransform(template.GetGeoTransform())##sets same geotransform as input
-    outputRaster.SetProjection(template.GetProjection())##sets same projection as input
+    outputRaster = driver.Create(pathOfOutput, template.columns, template.rows, 1, dataType)
+    outputRaster.SetGeoTransform(template.geoTransform)##sets same geotransform as input
+    outputRaster.SetProjection(template.projection)##sets same projection as input
     outputRaster.GetRasterBand(1).WriteArray(rasterDataArray)
-    outputRaster.GetRasterBand(1).SetNoDataValue(0)##if you want these values transparent
+    outputRaster.GetRasterBand(1).SetNoDataValue(noDataValue)##if you want these values transparent
     outputRaster.FlushCache() ##saves to disk!!
     outputRaster = None
+
+def writeNewRasterData(rasterDataArray, pathOfTemplateRaster, pathOfOutput):
+    # Saves a raster in int16 with a nodata value of 0
+    writeRasterData(rasterDataArray, pathOfTemplateRaster, pathOfOutput, gdal.GDT_Int16, 0)
     
 def writeNewRasterDataFloat32(rasterDataArray, pathOfTemplateRaster, pathOfOutput):
     # Saves a raster in Float32 with a nodata value of 0.0
-    # Inspired from https://gis.stackexchange.com/questions/164853/reading-modifying-and-writing-a-geotiff-with-gdal-in-python
-    # Loading template raster
-    template = gdal.Open(pathOfTemplateRaster)
-    driver = gdal.GetDriverByName("GTiff")
-    [rows, cols] = template.GetRasterBand(1).ReadAsArray().shape
-    outputRaster = driver.Create(pathOfOutput, cols, rows, 1, gdal.GDT_Float32)
-    outputRaster.SetGeoTransform(template.GetGeoTransform())##sets same geotransform as input
-    outputRaster.SetProjection(template.GetProjection())##sets same projection as input
-    outputRaster.GetRasterBand(1).WriteArray(rasterDataArray)
-    outputRaster.GetRasterBand(1).SetNoDataValue(0)##if you want these values transparent
-    outputRaster.FlushCache() ##saves to disk!!
-    outputRaster = None
+    writeRasterData(rasterDataArray, pathOfTemplateRaster, pathOfOutput, gdal.GDT_Float32, 0)
 
 def writeExistingRasterData(rasterDataArray, pathOfRasterToEdit):
     # Edits the data of an existing raster
@@ -87,26 +304,193 @@ def read_list(filePath):
         n_list = pickle.load(fp)
         return n_list
 
+class StandIndex:
+    """
+    Compact index of the pixels of each stand, built from the stands raster.
+    Rather than keeping a list of (row, column) tuples for each stand, the
+    flat indices of all forest pixels are stored in a single array sorted by
+    stand ID, with an array of offsets telling where each stand starts and
+    ends in it (the same idea as a CSR sparse matrix).
+    
+    It can be used like the old standCoordinatesDict : standIndex[standID]
+    returns the (rows, columns) arrays of the pixels of the stand, which can
+    be used directly to access or edit the values of a numpy array made from
+    a raster (e.g. managementMap[standIndex[standID]] = prescriptionID).
+    WARNING : as a consequence, len(standIndex[standID]) is always 2; use
+    standIndex.size(standID) to get the number of pixels of a stand.
+    """
+    def __init__(self, standRasterDataAll):
+        self.shape = standRasterDataAll.shape
+        # Path of the stands raster, if known; used to read other rasters
+        # by blocks along with it (see iterateStandBlocks)
+        self.rasterPath = None
+        flatStandData = standRasterDataAll.ravel()
+        # id 0 for stands = no forests
+        forestPixels = np.flatnonzero(flatStandData)
+        self._indexForestPixels(forestPixels, flatStandData[forestPixels])
+    
+    @classmethod
+    def fromRasterBlocks(cls, standMapPath):
+        """Builds a StandIndex by reading the stands raster strip by strip
+        (see iterateRasterBlocks), for rasters too big to be read at once.
+        The raster is read twice : once to count the pixels of each stand, and
+        once to put the pixels of each strip at their place in the index. So,
+        apart from the index itself, only one strip is in memory at a time."""
+        standIndex = cls.__new__(cls)
+        profile = getRasterProfile(standMapPath)
+        standIndex.shape = (profile.rows, profile.columns)
+        standIndex.rasterPath = standMapPath
+        # First, we count the pixels of each stand in each strip
+        listOfStripStandIDs = list()
+        listOfStripSizes = list()
+        for firstRow, numberOfStripRows, stripData in iterateRasterBlocks(standMapPath, dataType = rasterDataTypes["stands"]):
+            stripStandIDs, stripSizes = np.unique(stripData[stripData != 0], return_counts = True)
+            listOfStripStandIDs.append(stripStandIDs)
+            listOfStripSizes.append(stripSizes)
+        standIDs, stripStandPositions = np.unique(np.concatenate(listOfStripStandIDs), return_inverse = True)
+        sizes = np.bincount(stripStandPositions, weights = np.concatenate(listOfStripSizes),
+                            minlength = len(standIDs)).astype(np.int64)
+        del listOfStripStandIDs, listOfStripSizes
+        
+        # Then, we put the pixels of each strip after the ones of the same
+        # stand in the previous strips, which gives the same order as the
+        # stable sort of StandIndex.__init__
+        offsets = np.append(0, np.cumsum(sizes))
+        numberOfPixelsPlaced = np.zeros(len(standIDs), dtype = np.int64)
+        pixelIndices = np.empty(int(offsets[-1]), dtype = cls.pixelIndexDataType(standIndex.shape))
+        for firstRow, numberOfStripRows, stripData in iterateRasterBlocks(standMapPath, dataType = rasterDataTypes["stands"]):
+            flatStripData = stripData.ravel()
+            forestPixels = np.flatnonzero(flatStripData)
+            forestPixels = forestPixels[np.argsort(flatStripData[forestPixels], kind = "stable")]
+            pixelStandPositions = np.searchsorted(standIDs, flatStripData[forestPixels])
+            stripStandPositions, firstPixelOfStands, stripSizes = np.unique(pixelStandPositions,
+                                                                              return_index = True,
+                                                                              return_counts = True)
+            rankInStand = np.arange(len(forestPixels)) - np.repeat(firstPixelOfStands, stripSizes)
+            pixelIndices[offsets[pixelStandPositions] + numberOfPixelsPlaced[pixelStandPositions] + rankInStand] = forestPixels + firstRow * profile.columns
+            numberOfPixelsPlaced[stripStandPositions] += stripSizes
+        standIndex._setArrays(pixelIndices, standIDs, sizes)
+        return(standIndex)
+    
+    def _indexForestPixels(self, forestPixels, forestStandIDs):
+        # The stable sort keeps the pixels of a stand in the order of the raster
+        order = np.argsort(forestStandIDs, kind = "stable")
+        pixelIndices = forestPixels[order].astype(self.pixelIndexDataType(self.shape), copy = False)
+        standIDs, sizes = np.unique(forestStandIDs[order],
+                                    return_counts = True)
+        self._setArrays(pixelIndices, standIDs, sizes)
+    
+    @staticmethod
+    def pixelIndexDataType(shape):
+        """Data type of the flat indices of the pixels : int32 (4 bytes per
+        pixel, like the stands raster) if the raster has less than 2**31
+        pixels, int64 otherwise."""
+        return(np.int32 if shape[0] * shape[1] < 2**31 else np.int64)
+    
+    @classmethod
+    def fromArrays(cls, shape, pixelIndices, standIDs, sizes, rasterPath = None):
+        """Rebuilds a StandIndex from the arrays of another one (e.g. loaded
+        from the cache of static data, see loadStaticStandCache)."""
+        standIndex = cls.__new__(cls)
+        standIndex.shape = tuple(shape)
+        standIndex.rasterPath = rasterPath
+        standIndex._setArrays(pixelIndices, standIDs, sizes)
+        return(standIndex)
+    
+    def _setArrays(self, pixelIndices, standIDs, sizes):
+        self.pixelIndices = pixelIndices
+        self.standIDs = standIDs
+        self.sizes = sizes
+        self.offsets = np.append(0, np.cumsum(sizes))
+        # Position of each stand in the arrays above
+        self._positions = dict(zip(self.standIDs.tolist(), range(len(self.standIDs))))
+    
+    def flatIndices(self, standID):
+        """Returns the flat indices (as in array.ravel()) of the pixels of a stand."""
+        position = self._positions[standID]
+        return(self.pixelIndices[self.offsets[position]:self.offsets[position + 1]])
+    
+    def size(self, standID):
+        """Returns the number of pixels in a stand."""
+        return(int(self.sizes[self._positions[standID]]))
+    
+    def positionsOf(self, standIDs):
+        """Returns the positions of stands in self.standIDs (and so in all of
+        the arrays with one value per stand, like self.sizes).
+        Raises a KeyError if one of the stands is not in the index."""
+        standIDs = np.asarray(standIDs)
+        positions = np.searchsorted(self.standIDs, standIDs)
+        # searchsorted gives the position of the next stand for unknown IDs
+        isKnown = positions < len(self.standIDs)
+        if len(self.standIDs) > 0:
+            isKnown &= self.standIDs[np.minimum(positions, len(self.standIDs) - 1)] == standIDs
+        if not np.all(isKnown):
+            raise KeyError(np.atleast_1d(standIDs)[~np.atleast_1d(isKnown)][0].item())
+        return(positions)
+    
+    def pixelStandIDs(self):
+        """Returns the stand ID of each pixel of self.pixelIndices."""
+        return(np.repeat(self.standIDs, self.sizes))
+    
+    def keys(self):
+        return(self._positions.keys())
+    
+    def items(self):
+        for standID in self._positions:
+            yield (standID, self[standID])
+    
+    def __getitem__(self, standID):
+        return(np.unravel_index(self.flatIndices(standID), self.shape))
+    
+    def __contains__(self, standID):
+        return(standID in self._positions)
+    
+    def __iter__(self):
+        return(iter(self._positions))
+    
+    def __len__(self):
+        return(len(self._positions))
+
 def readingStandsCoordinates(standRasterDataAll, disableTQDM):
     '''Reads the stands map to get the coordinates of each pixel in a stand.
-    Returns a dictionnary giving the coordinates for each pixel for a given
-    stand ID. Locations are in (row, column) tuple format, as necessary to
-    access a value in a numpy array made from a raster by Rasterio.
-    standRasterDataAll must be a numpy array contained the data from your raster map.'''
+    Returns a StandIndex giving the coordinates for each pixel for a given
+    stand ID. Locations are in (rows, columns) arrays format, as necessary to
+    access values in a numpy array made from a raster by Rasterio.
+    standRasterDataAll must be a numpy array contained the data from your raster map,
+    or the path of the raster to read it by blocks (see iterateRasterBlocks).'''
     print("Reading stands coordinates...")
-    standCoordinatesDict = dict()
-    uniqueAllStandsID = np.unique(standRasterDataAll).tolist()
-    # id 0 for stands = no forests
-    uniqueAllStandsID.remove(0)
-    for standID in tqdm(uniqueAllStandsID, disable = disableTQDM):
-        # print(standID)
-        standCoordinatesDict[standID] = list()
-    for x in tqdm(range(standRasterDataAll.shape[0]), disable = disableTQDM):
-        for y in range(standRasterDataAll.shape[1]):
-            standID = standRasterDataAll[(x, y)]
-            if standID != 0:
-                standCoordinatesDict[standID].append((x, y))
-    return(standCoordinatesDict)
+    if isinstance(standRasterDataAll, str):
+        return(StandIndex.fromRasterBlocks(standRasterDataAll))
+    return(StandIndex(standRasterDataAll))
+
+def getValuesOfStandPixels(standCoordinatesDict, rasterData):
+    """Returns the values of a raster for the pixels of the stands, in the
+    order of standCoordinatesDict.pixelIndices. rasterData can be a numpy array
+    or the path of the raster to read it by blocks (see iterateRasterBlocks)."""
+    if isinstance(rasterData, str):
+        return(getRasterValuesAtPixels(rasterData, standCoordinatesDict.pixelIndices))
+    return(rasterData.ravel()[standCoordinatesDict.pixelIndices])
+
+def iterateStandBlocks(standCoordinatesDict, listOfPaths, dataType = None, maximumPixelsPerStrip = 2**24):
+    """Reads rasters strip by strip, along with the stands raster the stand
+    index was made from (standCoordinatesDict.rasterPath). For each strip,
+    yields the positions (in standCoordinatesDict.standIDs) of the stands of
+    its forest pixels, and a list with the values of these pixels in each
+    raster of listOfPaths. Used to compute statistics per stand with only
+    one strip of each raster in memory at a time (see zonalStats)."""
+    standStrips = iterateRasterBlocks(standCoordinatesDict.rasterPath,
+                                      maximumPixelsPerStrip = maximumPixelsPerStrip,
+                                      dataType = rasterDataTypes["stands"])
+    # We read the other rasters by the same strips as the stands raster
+    profile = getRasterProfile(standCoordinatesDict.rasterPath)
+    stripRows = stripRowsOfRaster(profile.columns, profile.blockSize[1], maximumPixelsPerStrip)
+    valueStrips = [iterateRasterBlocks(path, dataType = dataType, stripRows = stripRows) for path in listOfPaths]
+    for firstRow, numberOfStripRows, standStripData in standStrips:
+        flatStandStripData = standStripData.ravel()
+        forestPixels = np.flatnonzero(flatStandStripData)
+        pixelStandPositions = standCoordinatesDict.positionsOf(flatStandStripData[forestPixels])
+        listOfValues = [next(valueStrip)[2].ravel()[forestPixels] for valueStrip in valueStrips]
+        yield (pixelStandPositions, listOfValues)
 
 def splitLineAndRemoveTabsAndSpaces(lineString):
     """
@@ -118,11 +502,37 @@ def splitLineAndRemoveTabsAndSpaces(lineString):
         lineStringList.remove("")
     return(lineStringList)
 
-def harvestParameterFileParser(path):
+def readSpeciesList(speciesFilePath):
+    """
+    Reads the species codes in the species input file of LANDIS-II (the
+    first word of each line after "LandisData  Species", or the first column
+    if the file is a csv).
+    """
+    if speciesFilePath.lower().endswith(".csv"):
+        return(pd.read_csv(speciesFilePath).iloc[:, 0].astype(str).tolist())
+    speciesList = list()
+    with open(speciesFilePath, 'r') as file:
+        for line in file:
+            # We remove the comments (after ">>")
+            lineTokens = line.split(">>")[0].split()
+            if len(lineTokens) > 0 and lineTokens[0] != "LandisData":
+                speciesList.append(lineTokens[0])
+    return(speciesList)
+
+# Age categories of the cohorts removed, like "11-999" or "11-999(50%)"
+ageCategoryPattern = re.compile(r"(\d+)-(\d+)(?:\((\d+)%\))?")
+
+def harvestParameterFileParser(path, speciesList):
     """
     Parses the biomass harvest parameter file at the given path.
+    speciesList is the list of the species codes used in LANDIS-II (see
+    readSpeciesList); the lines starting with one of them are read as the
+    cohorts removed by a prescription.
     Returns a dictionnary with the needed parameters.
     
+    Each line is split in words (see splitLineAndRemoveTabsAndSpaces), and
+    read by the function associated to its first word in lineReaders below.
+    
     WARNING : To read the harvest file properly, make sure to :
     - Not use relative number of cohorts harvested for a given species, like
       "1/2" or "1/3". Since this script is made to be used with biomass harvest,
@@ -133,281 +543,675 @@ def harvestParameterFileParser(path):
     print("Reading harvest parameter file...")
     
     dictToReturn = dict()
+    speciesSet = set(speciesList)
+    # What we are reading at the current line
+    # We start the prescription IDs at 1 because the ID is for the raster;
+    # 0 = not forest, 1 = forest not harvested, and then it's the prescriptions.
+    state = {"prescription": "none", "singleRepeat": False, "prescriptionID": 1}
+    
+    def cohortsRemovedOfPrescription():
+        # We register the cohort removed in the case of a second pass (via
+        # SingleRepeat) in a different nested dictionnary
+        if not state["singleRepeat"]:
+            return(dictToReturn[state["prescription"]]["CohortRemoved"])
+        return(dictToReturn[state["prescription"]]["CohortRemoved"]["SingleRepeat"])
+    
+    def readTimestep(lineTokens, line):
+        # We get the timestep used by the extension
+        state["timestepLength"] = int(lineTokens[1])
+    
+    def readPrescription(lineTokens, line):
+        # If we find a new prescription, we initialize everything needed
+        prescriptionSelected = lineTokens[1]
+        state["prescription"] = prescriptionSelected
+        if prescriptionSelected not in dictToReturn:
+            dictToReturn[prescriptionSelected] = dict()
+            dictToReturn[prescriptionSelected]["Planting"] = "none"
+            dictToReturn[prescriptionSelected]["RepeatMode"] = "none"
+            dictToReturn[prescriptionSelected]["MaximumStandAge"] = 999
+            dictToReturn[prescriptionSelected]["MinimumStandAge"] = 0
+            dictToReturn[prescriptionSelected]["Commercial"] = True # Does it generate merchantable wood ?
+            dictToReturn[prescriptionSelected]["FullString"] = [line] # We keep all the lines of the prescription to be able to copy it to make different plantings
+            state["prescriptionID"] += 1
+            dictToReturn["_MaxPrescriptionID"] = state["prescriptionID"] # Special counter used to create new planting prescriptions later
+            dictToReturn[prescriptionSelected]["PrescriptionID"] = state["prescriptionID"]
+        state["singleRepeat"] = False
+    
+    def readMaximumAge(lineTokens, line):
+        dictToReturn[state["prescription"]]["MaximumStandAge"] = int(lineTokens[1])
+    
+    def readMinimumAge(lineTokens, line):
+        dictToReturn[state["prescription"]]["MinimumStandAge"] = int(lineTokens[1])
+    
+    def readSiteSelection(lineTokens, line):
+        # The line contains 2 words + the two numerical values we want
+        dictToReturn[state["prescription"]]["HarvestPropagation"] = [float(lineTokens[2]), float(lineTokens[3])]
     
-    # WARNING : Here is the list of species I use. Replace it with your own species
-    # codes that you use in LANDIS-II !
-    speciesList = ["ABIE.BAL","ACER.RUB","ACER.SAH","BETU.ALL","BETU.PAP",
-                   "FAGU.GRA","LARI.LAR","LARI.HYB","PICE.GLA","PICE.MAR",
-                   "PICE.RUB","PINU.BAN","PINU.RES","PINU.STR","POPU.TRE",
-                   "POPU.HYB","QUER.RUB","THUJ.SPP.ALL","TSUG.CAN"]
+    def readCohortsRemoved(lineTokens, line):
+        if not state["singleRepeat"]:
+            dictToReturn[state["prescription"]]["CohortRemoved"] = dict()
+        # We keep the mode (ClearCut, SpeciesList or PlantOnly); with ClearCut,
+        # no species are listed, but all of the cohorts are removed.
+        cohortsRemovedOfPrescription()["_Mode"] = lineTokens[1]
+    
+    def readPlanting(lineTokens, line):
+        dictToReturn[state["prescription"]]["Planting"] = lineTokens[1]
+    
+    def readCommercial(lineTokens, line):
+        if "FALSE" in line.upper():
+            dictToReturn[state["prescription"]]["Commercial"] = False
+    
+    def readSingleRepeat(lineTokens, line):
+        state["singleRepeat"] = True
+        dictToReturn[state["prescription"]]["CohortRemoved"]["SingleRepeat"] = dict()
+        dictToReturn[state["prescription"]]["RepeatMode"] = "SingleRepeat"
+        dictToReturn[state["prescription"]]["RepeatFrequency"] = int(lineTokens[1])
+    
+    def readMultipleRepeat(lineTokens, line):
+        dictToReturn[state["prescription"]]["RepeatMode"] = "MultipleRepeat"
+        dictToReturn[state["prescription"]]["RepeatFrequency"] = int(lineTokens[1])
+    
+    def readSpeciesCohortsRemoved(lineTokens, line):
+        # 3 cases :
+        # just ages (11-999)
+        # "All" keyword
+        # ages categories with biomass percent (11-999(90%))
+        species = lineTokens[0]
+        cohortsRemoved = cohortsRemovedOfPrescription()
+        if "/" in line: # Just in case their are relative cohort numbers in the file
+            raise ValueError("Do not use relative number of cohort harvested for a given species, like \"1/2\" or \"1/3\". Since this script is made to be used with biomass harvest, use things like \"11-999(50%)\" to harvest half of the biomass of each cohort.")
+        elif "All" in line or "all" in line:
+            cohortsRemoved[species] = "All"
+        else: # If not all, we have to break appart the age categories
+            cohortsRemoved[species] = list()
+            for ageCategory in lineTokens[1:]:
+                ageCategoryMatch = ageCategoryPattern.fullmatch(ageCategory)
+                if ageCategoryMatch is None:
+                    raise ValueError("Could not read the age category \"" + ageCategory + "\" of " + species + " in prescription " + state["prescription"] + ". Use things like \"11-999\" or \"11-999(50%)\".")
+                # We add a list describing 1) min age of category 2) max age of category 3) % of biomass harvested
+                minimumAge, maximumAge, percentage = ageCategoryMatch.groups()
+                cohortsRemoved[species].append([int(minimumAge), int(maximumAge), int(percentage) if percentage is not None else 100])
+    
+    lineReaders = {"Timestep": readTimestep,
+                   "Prescription": readPrescription,
+                   "MaximumAge": readMaximumAge,
+                   "MinimumAge": readMinimumAge,
+                   "SiteSelection": readSiteSelection,
+                   "CohortsRemoved": readCohortsRemoved,
+                   "Planting": readPlanting,
+                   "Commercial": readCommercial,
+                   "SingleRepeat": readSingleRepeat,
+                   "MultipleRepeat": readMultipleRepeat}
     
     with open(path, 'r') as file:
-        prescriptionSelected = "none"
-        prescriptionID = 1 # We start at 1 because the ID is for the raster;
-        # 0 = not forest, 1 = forest not harvested, and then it's the prescriptions.
         for line in file:
-            # print(line)
+            lineTokens = splitLineAndRemoveTabsAndSpaces(line)
+            firstWord = lineTokens[0] if len(lineTokens) > 0 else ""
             # We start by recording the lines if we're reading a prescription
-            if prescriptionSelected != "none" and "Prescription " not in line:
-                dictToReturn[prescriptionSelected]["FullString"].append(line)
-            if ">>-------------" in line:
-                prescriptionSelected = "none"
-                
-            # We get the timestep used by the extension
-            if "Timestep" in line:
-                timestepLength = int(splitLineAndRemoveTabsAndSpaces(line)[1])
-            # If we find a new prescription, we initialize everything needed
-            if "Prescription " in line:
-                prescriptionSelected = line[len("Prescription "):-1] #-1 removes the \n character at the end of each line
-                if prescriptionSelected not in dictToReturn:
-                    dictToReturn[prescriptionSelected] = dict()
-                    dictToReturn[prescriptionSelected]["Planting"] = "none"
-                    dictToReturn[prescriptionSelected]["RepeatMode"] = "none"
-                    dictToReturn[prescriptionSelected]["MaximumStandAge"] = 999
-                    dictToReturn[prescriptionSelected]["MinimumStandAge"] = 0
-                    dictToReturn[prescriptionSelected]["Commercial"] = True # Does it generate merchantable wood ?
-                    dictToReturn[prescriptionSelected]["FullString"] = [line] # We keep all the lines of the prescription to be able to copy it to make different plantings
-                    prescriptionID += 1
-                    dictToReturn["_MaxPrescriptionID"] = prescriptionID # Special counter used to create new planting prescriptions later
-                    dictToReturn[prescriptionSelected]["PrescriptionID"] = prescriptionID
-                singleRepeat = False
+            if state["prescription"] != "none" and firstWord != "Prescription":
+                dictToReturn[state["prescription"]]["FullString"].append(line)
+            if firstWord.startswith("-------------"):
+                state["prescription"] = "none"
             
-            # Else, we register the parameters of the prescription
-            elif "MaximumAge" in line:
-                maximumAge = splitLineAndRemoveTabsAndSpaces(line)[1]
-                dictToReturn[prescriptionSelected]["MaximumStandAge"] = int(maximumAge)
-            elif "MinimumAge" in line:
-                minimumAge = splitLineAndRemoveTabsAndSpaces(line)[1]
-                dictToReturn[prescriptionSelected]["MinimumStandAge"] = int(minimumAge)
-            elif "SiteSelection" in line:
-                # The line contains 2 words + the two numerical values we want
-                # We remove everything we don't need to get the two values
-                splittedLine = splitLineAndRemoveTabsAndSpaces(line)
-                # print(splittedLine)
-                dictToReturn[prescriptionSelected]["HarvestPropagation"] = [float(splittedLine[2]), float(splittedLine[3])]
-            elif "CohortsRemoved" in line and not singleRepeat:
-                dictToReturn[prescriptionSelected]["CohortRemoved"] = dict()
-            elif "Planting" in line:
-                plantingString = splitLineAndRemoveTabsAndSpaces(line)[1]
-                dictToReturn[prescriptionSelected]["Planting"] = plantingString
-            elif "Commercial" in line and "FALSE" in line.upper():
-                dictToReturn[prescriptionSelected]["Commercial"] = False
-            elif "SingleRepeat" in line:
-                singleRepeat = True
-                dictToReturn[prescriptionSelected]["CohortRemoved"]["SingleRepeat"] = dict()
-                dictToReturn[prescriptionSelected]["RepeatMode"] = "SingleRepeat"
-                repeatFrenquency = splitLineAndRemoveTabsAndSpaces(line)[1]
-                dictToReturn[prescriptionSelected]["RepeatFrequency"] = int(repeatFrenquency)
-            elif "MultipleRepeat" in line:
-                dictToReturn[prescriptionSelected]["RepeatMode"] = "MultipleRepeat"
-                repeatFrenquency = splitLineAndRemoveTabsAndSpaces(line)[1]
-                dictToReturn[prescriptionSelected]["RepeatFrequency"] = int(repeatFrenquency)
-                
-            # If we get to the part about the cohort removed, it's a bit more tricky
-            # to register
-            # In particular, we will register the cohort removed in the case of a
-            # second pass (via SingleRepeat) in a different nested dictionnary
-            for species in speciesList:
-                if species in line and "Prescription " not in line and "Plant" not in line:
-                    if not singleRepeat:
-                        dictToReturn[prescriptionSelected]["CohortRemoved"][species] = dict()
-                    else:
-                        dictToReturn[prescriptionSelected]["CohortRemoved"]["SingleRepeat"][species] = dict()
-                    # 3 cases :
-                    # just ages (11-999)
-                    # "All" keyword
-                    # ages categories with biomass percent (11-999(90%))
-                    # print(line)
-                    if "/" in line: # Just in case their are relative cohort numbers in the file
-                        raise ValueError("Do not use relative number of cohort harvested for a given species, like \"1/2\" or \"1/3\". Since this script is made to be used with biomass harvest, use things like \"11-999(50%)\" to harvest half of the biomass of each cohort.")
-                    elif "All" in line or "all" in line:
-                        if not singleRepeat:
-                            dictToReturn[prescriptionSelected]["CohortRemoved"][species] = "All"
-                        else:
-                            dictToReturn[prescriptionSelected]["CohortRemoved"]["SingleRepeat"][species] = "All"
-                    else: # If not all, we have to break appart the age categories
-                        if not singleRepeat:
-                            dictToReturn[prescriptionSelected]["CohortRemoved"][species] = list()
-                        else:
-                            dictToReturn[prescriptionSelected]["CohortRemoved"]["SingleRepeat"][species] = list()
-                        splittedLine = splitLineAndRemoveTabsAndSpaces(line)
-                        # print(splittedLine)
-                        for ageCategory in splittedLine[1:]:
-                            if "%" not in ageCategory:
-                                splitAgeCategory = ageCategory.split("-")
-                                # We add a list describing 1) min age of category 2) max age of category 3) % of biomass harvested
-                                if not singleRepeat:
-                                    dictToReturn[prescriptionSelected]["CohortRemoved"][species].append([int(splitAgeCategory[0]), int(splitAgeCategory[1]), 100])
-                                else:
-                                    dictToReturn[prescriptionSelected]["CohortRemoved"]["SingleRepeat"][species].append([int(splitAgeCategory[0]), int(splitAgeCategory[1]), 100])
-                            else:
-                                splitAgeCategory = ageCategory.replace("(", "-").replace("%)", "").split("-")
-                                if not singleRepeat:
-                                    dictToReturn[prescriptionSelected]["CohortRemoved"][species].append([int(splitAgeCategory[0]), int(splitAgeCategory[1]), int(splitAgeCategory[2])])
-                                else:
-                                    dictToReturn[prescriptionSelected]["CohortRemoved"]["SingleRepeat"][species].append([int(splitAgeCategory[0]), int(splitAgeCategory[1]), int(splitAgeCategory[2])])
-                        
-            if "HarvestImplementations" in line:
+            if firstWord in lineReaders:
+                lineReaders[firstWord](lineTokens, line)
+            elif firstWord in speciesSet:
+                readSpeciesCohortsRemoved(lineTokens, line)
+            elif firstWord == "HarvestImplementations":
                 break
                 
-    return(dictToReturn, timestepLength)
+    return(dictToReturn, state["timestepLength"])
+
+class CohortTable:
+    """
+    Compact table of the cohorts of each stand : one row per stand, species
+    and age, stored as four numpy arrays (stand ID, species code, age and
+    biomass in Mg/ha) sorted by stand ID, with an array of offsets telling
+    where the rows of each stand start and end.
+    
+    The group-by methods (biomassPerStand, biomassPerStandPerSpecies) return
+    one value per stand in the order of self.uniqueStandIDs, computed in one
+    go for the whole landscape.
+    It can also be used like the old nested dictionnary, as
+    cohortTable[standID][species][age] -> biomass. Like the dictionnary, it
+    doesn't contain stands without cohorts, so check with "standID in cohortTable".
+    """
+    def __init__(self, standIDs, speciesCodes, ages, biomass, speciesNames):
+        # The rows must already be sorted by stand ID
+        self.standIDs = np.asarray(standIDs, dtype = np.int32)
+        self.speciesCodes = np.asarray(speciesCodes, dtype = np.uint8)
+        self.ages = np.asarray(ages, dtype = np.int16)
+        self.biomass = np.asarray(biomass, dtype = np.float32)
+        self.speciesNames = list(speciesNames)
+        self._speciesCodesOfNames = dict(zip(self.speciesNames, range(len(self.speciesNames))))
+        self.uniqueStandIDs, numberOfRowsPerStand = np.unique(self.standIDs, return_counts = True)
+        self.offsets = np.append(0, np.cumsum(numberOfRowsPerStand))
+        # Position of each row's stand in self.uniqueStandIDs
+        self._rowStandPositions = np.repeat(np.arange(len(self.uniqueStandIDs)), numberOfRowsPerStand)
+        self._positions = dict(zip(self.uniqueStandIDs.tolist(), range(len(self.uniqueStandIDs))))
+    
+    def _rowsOf(self, listOfSpecies = None, minimumAge = None, maximumAge = None):
+        """Returns a boolean mask of the rows for the given species and age range (included)."""
+        rows = np.ones(len(self.standIDs), dtype = bool)
+        if listOfSpecies is not None:
+            speciesCodes = [self._speciesCodesOfNames[species] for species in listOfSpecies if species in self._speciesCodesOfNames]
+            rows &= np.isin(self.speciesCodes, speciesCodes)
+        if minimumAge is not None:
+            rows &= self.ages >= minimumAge
+        if maximumAge is not None:
+            rows &= self.ages <= maximumAge
+        return(rows)
+    
+    def biomassPerStand(self, listOfSpecies = None, minimumAge = None, maximumAge = None):
+        """Returns the total biomass of each stand for a list of species
+        (all species if None) and for the cohorts in an age range (included)."""
+        rows = self._rowsOf(listOfSpecies, minimumAge, maximumAge)
+        return(np.bincount(self._rowStandPositions[rows],
+                           weights = self.biomass[rows],
+                           minlength = len(self.uniqueStandIDs)))
+    
+    def biomassPerStandPerSpecies(self, minimumAge = None, maximumAge = None):
+        """Returns a 2D array with the biomass of each stand (rows) for each
+        species (columns, in the order of self.speciesNames)."""
+        rows = self._rowsOf(None, minimumAge, maximumAge)
+        numberOfSpecies = max(len(self.speciesNames), 1)
+        biomass = np.bincount(self._rowStandPositions[rows] * numberOfSpecies + self.speciesCodes[rows],
+                              weights = self.biomass[rows],
+                              minlength = len(self.uniqueStandIDs) * numberOfSpecies)
+        return(biomass.reshape(len(self.uniqueStandIDs), numberOfSpecies))
+    
+    def removedBiomassPerStand(self, removalFractions):
+        """Returns the biomass of each stand that would be removed with the
+        given fractions of removal for each species (rows, in the order of
+        self.speciesNames) and age (columns), like the ones made by
+        compileCohortRemovalFractions."""
+        # Cohorts older than the last column are not removed
+        rows = self.ages < removalFractions.shape[1]
+        return(np.bincount(self._rowStandPositions[rows],
+                           weights = self.biomass[rows] * removalFractions[self.speciesCodes[rows], self.ages[rows]],
+                           minlength = len(self.uniqueStandIDs)))
+    
+    def biomassOfStand(self, standID, listOfSpecies = None, minimumAge = None, maximumAge = None):
+        """Returns the total biomass of a single stand for a list of species
+        (all species if None) and for the cohorts in an age range (included)."""
+        position = self._positions[standID]
+        rows = slice(self.offsets[position], self.offsets[position + 1])
+        biomass = self.biomass[rows]
+        speciesCodes = self.speciesCodes[rows]
+        ages = self.ages[rows]
+        selected = np.ones(len(biomass), dtype = bool)
+        if listOfSpecies is not None:
+            selected &= np.isin(speciesCodes, [self._speciesCodesOfNames[species] for species in listOfSpecies if species in self._speciesCodesOfNames])
+        if minimumAge is not None:
+            selected &= ages >= minimumAge
+        if maximumAge is not None:
+            selected &= ages <= maximumAge
+        return(float(biomass[selected].sum(dtype = np.float64)))
+    
+    def __getitem__(self, standID):
+        """Returns the cohorts of a stand as a dictionnary {species : {age : biomass}}."""
+        position = self._positions[standID]
+        rows = slice(self.offsets[position], self.offsets[position + 1])
+        standDict = dict()
+        for speciesCode, age, biomass in zip(self.speciesCodes[rows].tolist(), self.ages[rows].tolist(), self.biomass[rows].tolist()):
+            if self.speciesNames[speciesCode] not in standDict:
+                standDict[self.speciesNames[speciesCode]] = dict()
+            standDict[self.speciesNames[speciesCode]][age] = biomass
+        return(standDict)
+    
+    def keys(self):
+        return(self._positions.keys())
+    
+    def items(self):
+        for standID in self._positions:
+            yield (standID, self[standID])
+    
+    def __contains__(self, standID):
+        return(standID in self._positions)
+    
+    def __iter__(self):
+        return(iter(self._positions))
+    
+    def __len__(self):
+        return(len(self._positions))
+
+def readingStandMapCodeCounts(standCoordinatesDict, communityMapCodeData):
+    """Counts how many pixels of each stand have each mapcode of the
+    community map made by Output Biomass Community.
+    Returns a sparse matrix (scipy CSR) with one row per stand, in the order
+    of standCoordinatesDict.standIDs, and one column per mapcode value.
+    With it, any value given per mapcode can be summed for each stand with a
+    single multiplication (see aggregateMapCodeValuesToStands).
+    communityMapCodeData can also be the path of the community map, to read
+    it by blocks (strip by strip along with the stands raster if its path
+    is known, see iterateStandBlocks)."""
+    if isinstance(communityMapCodeData, str) and standCoordinatesDict.rasterPath is not None:
+        strips = iterateStandBlocks(standCoordinatesDict, [communityMapCodeData], rasterDataTypes["mapcodes"])
+    else:
+        pixelStandPositions = np.repeat(np.arange(len(standCoordinatesDict), dtype = np.int64),
+                                        standCoordinatesDict.sizes)
+        strips = [(pixelStandPositions, [getValuesOfStandPixels(standCoordinatesDict, communityMapCodeData)])]
+    # For each strip, we count the pixels of each (stand, mapcode) pair;
+    # the duplicate pairs are summed when converting to CSR
+    listOfStripPairs = list()
+    for pixelStandPositions, (pixelMapCodes,) in strips:
+        pixelMapCodes = pixelMapCodes.astype(np.int64)
+        # Negative values are nodata, not mapcodes
+        validPixels = pixelMapCodes >= 0
+        stripMatrix = sparse.coo_matrix((np.ones(np.count_nonzero(validPixels), dtype = np.int32),
+                                         (pixelStandPositions[validPixels], pixelMapCodes[validPixels])),
+                                        shape = (len(standCoordinatesDict), int(pixelMapCodes.max(initial = 0)) + 1)).tocsr().tocoo()
+        listOfStripPairs.append((stripMatrix.row, stripMatrix.col, stripMatrix.data))
+    numberOfMapCodes = max([int(stripCols.max()) + 1 for stripRows, stripCols, stripData in listOfStripPairs if len(stripCols) > 0], default = 0)
+    standMapCodeMatrix = sparse.coo_matrix((np.concatenate([stripData for stripRows, stripCols, stripData in listOfStripPairs]),
+                                            (np.concatenate([stripRows for stripRows, stripCols, stripData in listOfStripPairs]),
+                                             np.concatenate([stripCols for stripRows, stripCols, stripData in listOfStripPairs]))),
+                                           shape = (len(standCoordinatesDict), numberOfMapCodes)).tocsr()
+    standMapCodeMatrix.sum_duplicates()
+    return(standMapCodeMatrix)
+
+def aggregateMapCodeValuesToStands(standMapCodeMatrix, mapCodes, values):
+    """Sums values given for a list of mapcodes (e.g. the biomass of the
+    rows of the community csv) over all of the pixels of each stand.
+    The same mapcode can appear several times in mapCodes; its values are
+    summed. Returns an array with one value per stand, in the order of
+    the rows of standMapCodeMatrix (see readingStandMapCodeCounts)."""
+    mapCodes = np.asarray(mapCodes)
+    # Mapcodes that are not in the map are in no stand
+    inMap = (mapCodes >= 0) & (mapCodes < standMapCodeMatrix.shape[1])
+    valuePerMapCode = np.bincount(mapCodes[inMap],
+                                  weights = np.asarray(values, dtype = np.float64)[inMap],
+                                  minlength = standMapCodeMatrix.shape[1])
+    return(standMapCodeMatrix @ valuePerMapCode)
+
+def readCommunityCsv(communityCsvPath):
+    """Reads the communities csv made by Output Biomass Community in typed
+    columns (MapCode, SpeciesName, CohortAge and CohortBiomass).
+    0 is mapcode; 1 is species; 2 is cohort; 3 is biomass."""
+    return(pd.read_csv(communityCsvPath,
+                       header = 0,
+                       names = ["MapCode", "SpeciesName", "CohortAge", "CohortBiomass"],
+                       dtype = {"MapCode": np.int32,
+                                "SpeciesName": "category",
+                                "CohortAge": np.int16,
+                                "CohortBiomass": np.float32}))
 
 def readCommunitiesComplete(communityCsvPath,
                             communityMapPath,
                             standCoordinatesDict,
-                            disableTQDM):
+                            disableTQDM,
+                            standMapCodeMatrix = None,
+                            communityCsv = None):
     """
     Reads the communities csv and raster map made by Output Biomass Community
-    to make a dictionnary containing the species and age cohorts for each
+    to make a CohortTable containing the species and age cohorts for each
     species and biomass for these cohorts for all of the pixels of a stand.
-    WARNING : the dictionnary doesn't contain entries for stands that have
+    WARNING : the table doesn't contain entries for stands that have
     no cohorts/no biomass, and no entries for species that are not in a stand
     or cohorts that do not exist for a species. This saves on a lot of space,
-    but one got to check if the entries are there when using the dictionnary.
+    but one got to check if the entries are there when using the table.
+    If standMapCodeMatrix (see readingStandMapCodeCounts) is given, the
+    community map is not read again; if communityCsv (see readCommunityCsv)
+    is given, the csv is not read again.
     """
 
     # communityCsvPath = "./community-input-file-" + str(timestep) + ".csv"
     # communityMapPath = "./output-community-" + str(timestep) + ".img"
     print("Reading communities csv and map...")
-    # We only need the mapcode column from the csv from now.
-    communityCsv = pd.read_csv(communityCsvPath, usecols=['MapCode'])
-    communityMapCodeData = getRasterData(communityMapPath)
-
-    # We make the dictionnary of the amount of times a stand is associated
-    # to a mapcode
-    print("Creating mapcode community dictionnary...")
-    dictMapCodeStands = dict()
-    for uniqueMapCode in communityCsv["MapCode"].unique():
-        dictMapCodeStands[uniqueMapCode] = dict()
-        
-    for standID in standCoordinatesDict.keys():
-        for pixel in standCoordinatesDict[standID]:
-            mapcode = communityMapCodeData[pixel]
-            # If the mapcode is not already in the dictionnary, it was not in
-            # the CSV; and if it's not in the CSV, it's because it's a mapcode
-            # associated to no cohorts at all(total biomass of 0)
-            if mapcode in dictMapCodeStands:
-                if standID not in dictMapCodeStands[mapcode]:
-                    dictMapCodeStands[mapcode][standID] = 1
-                else:
-                    dictMapCodeStands[mapcode][standID] += 1
+    # We read the csv only once, in typed columns.
+    if communityCsv is None:
+        communityCsv = readCommunityCsv(communityCsvPath)
+    csvMapCodes = communityCsv["MapCode"].to_numpy()
+    speciesCodes = communityCsv["SpeciesName"].cat.codes.to_numpy()
+    speciesNames = communityCsv["SpeciesName"].cat.categories.tolist()
+    cohortAges = communityCsv["CohortAge"].to_numpy()
+    cohortBiomass = communityCsv["CohortBiomass"].to_numpy()
+
+    # We get the amount of times a stand is associated to a mapcode.
+    if standMapCodeMatrix is None:
+        print("Counting mapcode pixels in stands...")
+        standMapCodeMatrix = readingStandMapCodeCounts(standCoordinatesDict,
+                                                       getRasterData(communityMapPath, rasterDataTypes["mapcodes"]))
+    # In the CSC format, the stands of each mapcode are stored one mapcode after
+    # the other, which is what we need to join them to the csv.
+    # If a mapcode is not in the CSV, it's because it's a mapcode
+    # associated to no cohorts at all(total biomass of 0), so it's never joined.
+    mapCodeStandMatrix = standMapCodeMatrix.tocsc()
+    pairStandPositions = mapCodeStandMatrix.indices.astype(np.int64)
+    pairPixelCounts = mapCodeStandMatrix.data
+    # Mapcodes of the csv that are not in the map are in no stand
+    csvMapCodesInMap = np.where((csvMapCodes >= 0) & (csvMapCodes < mapCodeStandMatrix.shape[1]),
+                                csvMapCodes, mapCodeStandMatrix.shape[1])
+    pairBoundaries = np.append(mapCodeStandMatrix.indptr, mapCodeStandMatrix.indptr[-1])
     
-    # Now, we can read the CSV file and fill in a second dictionnary with the
-    # information for each stand
-    # To lighten it, we won't put stands that have no biomass
+    # Now, we join each row of the csv to all of the stands containing its mapcode
+    # To lighten the results, we won't put stands that have no biomass
     # (IMPORTANT FOR OTHER FUNCTIONS : have to check if stand is in dictionnary)
     print("Creating stand community dictionnary...")
+    firstPairOfRow = pairBoundaries[csvMapCodesInMap]
+    numberOfPairsOfRow = pairBoundaries[csvMapCodesInMap + 1] - firstPairOfRow
+    rowOfJoin = np.repeat(np.arange(len(csvMapCodes)), numberOfPairsOfRow)
+    pairOfJoin = (np.repeat(firstPairOfRow, numberOfPairsOfRow)
+                  + np.arange(len(rowOfJoin))
+                  - np.repeat(np.cumsum(numberOfPairsOfRow) - numberOfPairsOfRow, numberOfPairsOfRow))
+    # If the stand has multiple pixel with this mapcode, we multiply
+    # the biomass with the number of pixels
+    # WARNING : Need to transform biomass from g/m2 to Mg/ha by dividing by 100
+    biomassOfJoin = (cohortBiomass[rowOfJoin] / 100) * pairPixelCounts[pairOfJoin]
+    # Finally, we sum the biomass for each stand/species/cohort, as they can
+    # come from several mapcodes of the stand
+    maximumAge = int(cohortAges.max()) + 1 if len(cohortAges) > 0 else 1
+    cohortKeys = ((pairStandPositions[pairOfJoin] * len(speciesNames) + speciesCodes[rowOfJoin].astype(np.int64))
+                  * maximumAge + cohortAges[rowOfJoin])
+    uniqueCohortKeys, cohortOfJoin = np.unique(cohortKeys, return_inverse = True)
+    biomassOfCohorts = np.bincount(cohortOfJoin, weights = biomassOfJoin, minlength = len(uniqueCohortKeys))
     
-    standCommunitiesDict = dict()
-    with open(communityCsvPath, 'r') as file:
-        reader = csv.reader(file)
-        headers = next(reader)  # Read the header row
-        for row in tqdm(reader, total=len(communityCsv["MapCode"]), disable = disableTQDM):
-            # 0 is mapcode; 1 is species; 2 is cohort; 3 is biomass.
-            for standID in dictMapCodeStands[int(row[0])]:
-                if standID not in standCommunitiesDict:
-                    standCommunitiesDict[standID] = dict()
-                    standCommunitiesDict[standID][row[1]] = dict()
-                    standCommunitiesDict[standID][row[1]][int(row[2])] = 0
-                # If species not indicated for this stand, we put it
-                elif row[1] not in standCommunitiesDict[standID]:
-                    standCommunitiesDict[standID][row[1]] = dict()
-                    standCommunitiesDict[standID][row[1]][int(row[2])] = 0
-                # If age cohort not indicated for this stand/species, we put it
-                elif int(row[2]) not in standCommunitiesDict[standID][row[1]]:
-                    standCommunitiesDict[standID][row[1]][int(row[2])] = 0
-                # Finally, we enter the biomass for the stand/species/cohort
-                # If the stand has multiple pixel with this mapcode, we multiply
-                # the biomass with the number of pixels
-                # WARNING : Need to transform biomass from g/m2 to Mg/ha by dividing by 100
-                standCommunitiesDict[standID][row[1]][int(row[2])] += (int(row[3])/100)*dictMapCodeStands[int(row[0])][standID]
-        
-    return(standCommunitiesDict)
+    # The keys are sorted by stand first, as needed by the CohortTable
+    standCommunitiesTable = CohortTable(standCoordinatesDict.standIDs[uniqueCohortKeys // maximumAge // len(speciesNames)],
+                                        uniqueCohortKeys // maximumAge % len(speciesNames),
+                                        uniqueCohortKeys % maximumAge,
+                                        biomassOfCohorts,
+                                        speciesNames)
+    return(standCommunitiesTable)
     
 def GetBiomassInstand(standCompositionDict, standID, listOfSpecies):
     """Retrieves the total biomass in a stand for a list of species.
     Returns a single biomass value."""
-    sumOfBiomass = 0
-    for species in listOfSpecies:
-        if species in standCompositionDict[standID]:
-            sumOfBiomass += sum(standCompositionDict[standID][species].values())
-    return(sumOfBiomass)
-
-def readingStandsAges(standMapPath, maxAgeMapsFolderPath, timestep, timestepLength, disableTQDM):
-    '''Uses the stand maps and max age map to compute the mean age of each stand
+    return(standCompositionDict.biomassOfStand(standID, listOfSpecies))
+
+def zonalStats(standCoordinatesDict, valueRasterData, stats = ["mean"]):
+    """Computes statistics of the values of a raster for the pixels of each
+    stand, for all stands at once.
+    stats is a list containing any of "mean", "max", "min", "mode", "sum",
+    "count", "nonzero" (number of pixels with a value other than 0), or "percentileXX" (e.g. "percentile90", with the same linear
+    interpolation as np.percentile). For "mode", ties are broken by taking
+    the smallest value.
+    valueRasterData can be a numpy array or the path of the raster, to read
+    it by blocks. If the path of the stands raster is known
+    (standCoordinatesDict.rasterPath), all of the statistics but the
+    percentiles are then accumulated strip by strip (see zonalStatsByBlocks).
+    Returns a dictionnary giving, for each statistic, a numpy array with one
+    value per stand in the order of standCoordinatesDict.standIDs (use
+    dict(zip(standCoordinatesDict.standIDs.tolist(), array.tolist())) to get
+    a dictionnary associating the values to the stand IDs)."""
+    if (isinstance(valueRasterData, str) and standCoordinatesDict.rasterPath is not None
+        and not any(stat.startswith("percentile") for stat in stats)):
+        return(zonalStatsByBlocks(standCoordinatesDict, valueRasterData, stats))
+    return(zonalStatsOfStandPixels(standCoordinatesDict,
+                                   getValuesOfStandPixels(standCoordinatesDict, valueRasterData),
+                                   stats))
+
+def zonalStatsOfStandPixels(standCoordinatesDict, values, stats = ["mean"]):
+    """Same as zonalStats, but for values already given for the pixels of the
+    stands, in the order of standCoordinatesDict.pixelIndices (see
+    getValuesOfStandPixels); e.g. values computed from several rasters."""
+    # The pixels of the stand index are sorted by stand, so the values of
+    # each stand are in a segment starting at its offset.
+    starts = standCoordinatesDict.offsets[:-1]
+    counts = standCoordinatesDict.sizes
+    numberOfStands = len(standCoordinatesDict)
+    
+    results = dict()
+    sortedValues = None
+    for stat in stats:
+        if numberOfStands == 0:
+            results[stat] = np.zeros(0)
+        elif stat == "count":
+            results[stat] = counts.copy()
+        elif stat == "nonzero":
+            results[stat] = np.add.reduceat((values != 0).astype(np.int64), starts)
+        elif stat == "sum":
+            results[stat] = np.add.reduceat(values.astype(np.float64), starts)
+        elif stat == "mean":
+            results[stat] = np.add.reduceat(values.astype(np.float64), starts) / counts
+        elif stat == "max":
+            results[stat] = np.maximum.reduceat(values, starts)
+        elif stat == "min":
+            results[stat] = np.minimum.reduceat(values, starts)
+        elif stat == "mode" or stat.startswith("percentile"):
+            # For these, we need the values sorted inside of each stand
+            if sortedValues is None:
+                standPositions = np.repeat(np.arange(numberOfStands), counts)
+                sortedValues = values[np.lexsort((values, standPositions))]
+            if stat == "mode":
+                # We find the runs of equal values in each stand, and keep the longest
+                isRunStart = np.ones(len(sortedValues), dtype = bool)
+                isRunStart[1:] = (sortedValues[1:] != sortedValues[:-1]) | (standPositions[1:] != standPositions[:-1])
+                runStarts = np.flatnonzero(isRunStart)
+                runLengths = np.diff(np.append(runStarts, len(sortedValues)))
+                runStandPositions = standPositions[runStarts]
+                runOrder = np.lexsort((sortedValues[runStarts], -runLengths, runStandPositions))
+                isFirstRunOfStand = np.ones(len(runOrder), dtype = bool)
+                isFirstRunOfStand[1:] = runStandPositions[runOrder][1:] != runStandPositions[runOrder][:-1]
+                results[stat] = sortedValues[runStarts[runOrder[isFirstRunOfStand]]]
+            else:
+                rank = (counts - 1) * float(stat[len("percentile"):]) / 100
+                lowerRank = np.floor(rank).astype(np.int64)
+                upperRank = np.ceil(rank).astype(np.int64)
+                lowerValues = sortedValues[starts + lowerRank].astype(np.float64)
+                upperValues = sortedValues[starts + upperRank].astype(np.float64)
+                results[stat] = lowerValues + (upperValues - lowerValues) * (rank - lowerRank)
+        else:
+            raise ValueError("Unknown statistic for zonalStats : " + str(stat))
+    return(results)
+
+def zonalStatsByBlocks(standCoordinatesDict, valueRasterPath, stats = ["mean"]):
+    """Same as zonalStats, but reads the raster strip by strip along with the
+    stands raster (see iterateStandBlocks), and accumulates the statistics
+    of each strip; so only one strip of the rasters is in memory at a time.
+    Works for "mean", "max", "min", "mode", "sum", "nonzero" and "count"."""
+    strips = ((pixelStandPositions, values) for pixelStandPositions, (values,) in iterateStandBlocks(standCoordinatesDict, [valueRasterPath]))
+    return(zonalStatsOfStrips(standCoordinatesDict, strips, stats))
+
+def zonalStatsOfStrips(standCoordinatesDict, strips, stats = ["mean"]):
+    """Accumulates the statistics of zonalStatsByBlocks over strips, an
+    iterable of (positions of the stands of the pixels, values of the pixels)
+    like the ones given by iterateStandBlocks; e.g. values computed from
+    several rasters read strip by strip."""
+    numberOfStands = len(standCoordinatesDict)
+    sums = np.zeros(numberOfStands)
+    minimums = None
+    maximums = None
+    # For the mode, the number of pixels of each (stand, value) pair seen so far
+    pairPositions = np.zeros(0, dtype = np.int32)
+    pairValues = None
+    pairCounts = np.zeros(0, dtype = np.int32)
+    numberOfNonZeros = np.zeros(numberOfStands, dtype = np.int64)
+    for pixelStandPositions, values in strips:
+        if minimums is None:
+            # We start from the highest (or lowest) possible value
+            extremeValues = np.iinfo(values.dtype) if np.issubdtype(values.dtype, np.integer) else np.finfo(values.dtype)
+            minimums = np.full(numberOfStands, extremeValues.max, dtype = values.dtype)
+            maximums = np.full(numberOfStands, extremeValues.min, dtype = values.dtype)
+            pairValues = np.zeros(0, dtype = values.dtype)
+        if "sum" in stats or "mean" in stats:
+            sums += np.bincount(pixelStandPositions, weights = values, minlength = numberOfStands)
+        if "nonzero" in stats:
+            numberOfNonZeros += np.bincount(pixelStandPositions[values != 0], minlength = numberOfStands)
+        if "min" in stats:
+            np.minimum.at(minimums, pixelStandPositions, values)
+        if "max" in stats:
+            np.maximum.at(maximums, pixelStandPositions, values)
+        if "mode" in stats:
+            # We add the pixels of the strip to the pairs seen so far, and
+            # add up the counts of the same pairs
+            pairPositions = np.concatenate((pairPositions, pixelStandPositions.astype(np.int32)))
+            pairValues = np.concatenate((pairValues, values))
+            pairCounts = np.concatenate((pairCounts, np.ones(len(values), dtype = np.int32)))
+            order = np.lexsort((pairValues, pairPositions))
+            pairPositions, pairValues, pairCounts = pairPositions[order], pairValues[order], pairCounts[order]
+            del order
+            isPairStart = np.ones(len(pairPositions), dtype = bool)
+            isPairStart[1:] = (pairValues[1:] != pairValues[:-1]) | (pairPositions[1:] != pairPositions[:-1])
+            pairStarts = np.flatnonzero(isPairStart)
+            pairCounts = np.add.reduceat(pairCounts, pairStarts) if len(pairStarts) > 0 else pairCounts
+            pairPositions = pairPositions[pairStarts]
+            pairValues = pairValues[pairStarts]
+    
+    results = dict()
+    for stat in stats:
+        if stat == "count":
+            results[stat] = standCoordinatesDict.sizes.copy()
+        elif stat == "nonzero":
+            results[stat] = numberOfNonZeros
+        elif stat == "sum":
+            results[stat] = sums
+        elif stat == "mean":
+            results[stat] = sums / standCoordinatesDict.sizes
+        elif stat == "max":
+            results[stat] = maximums
+        elif stat == "min":
+            results[stat] = minimums
+        elif stat == "mode":
+            # We keep the value with the highest count in each stand
+            # (the smallest one in case of ties, like zonalStats)
+            pairOrder = np.lexsort((pairValues, -pairCounts, pairPositions))
+            isFirstPairOfStand = np.ones(len(pairOrder), dtype = bool)
+            isFirstPairOfStand[1:] = pairPositions[pairOrder][1:] != pairPositions[pairOrder][:-1]
+            results[stat] = pairValues[pairOrder[isFirstPairOfStand]]
+        else:
+            raise ValueError("Unknown statistic for zonalStatsByBlocks : " + str(stat))
+    return(results)
+
+def readingStandsAges(standCoordinatesDict, maxAgeMapsFolderPath, timestep, timestepLength, disableTQDM, readByBlocks = False, cohortMaxAgeData = None):
+    '''Uses the stand index and max age map to compute the mean age of each stand
     (average of the age of the oldest cohorts in each pixels of the stand).
     Returns a dictionnary associating an age to a stand ID.
-    The max age map is taken from the previous timestep to the current one.'''
+    The max age map is taken from the previous timestep to the current one.
+    If readByBlocks is True, the map is read by blocks (see iterateRasterBlocks).
+    If cohortMaxAgeData is given, the map is not read again.'''
     print("Reading stands age...")
     
-    standData = getRasterData(standMapPath)
-    uniqueAllStandsID = np.unique(standData).tolist()
-    # id 0 for stands = no forests
-    uniqueAllStandsID.remove(0)
-    cohortMaxAgeData = getRasterData(maxAgeMapsFolderPath + "AGE-MAX-" + str(timestep - timestepLength) + ".img")
-    maxAgeDict = dict()
-    # Little trick to use the power of numpy below
-    # We make an array with the pixels we want the value of, and another
-    # with the values
-    pixelCoordinates = np.where(standData != 0)
-    standIDinPixelCoordinates = standData[pixelCoordinates]
-    for standID in tqdm(uniqueAllStandsID, disable = disableTQDM):
-        maxAgeDict[standID] = list()
-    # We get the data for the harvestable pixels
-    cohortMaxAgeInForestPixel = cohortMaxAgeData[pixelCoordinates]
-    # We fill the dictionnary with the different values of max cohort age for each
-    # pixels in a stand
-    for i in tqdm(range(0, len(pixelCoordinates[0])), disable = disableTQDM):
-        maxAgeDict[standIDinPixelCoordinates[i]].append(cohortMaxAgeInForestPixel[i])
+    if cohortMaxAgeData is None:
+        cohortMaxAgeData = maxAgeMapsFolderPath + "AGE-MAX-" + str(timestep - timestepLength) + ".img"
+        if not readByBlocks:
+            cohortMaxAgeData = getRasterData(cohortMaxAgeData, rasterDataTypes["ages"])
+    meanMaxAge = zonalStats(standCoordinatesDict, cohortMaxAgeData, ["mean"])["mean"]
     # We make a dictionnary containing the mean max age for each stand
-    standAgeDict = dict()
-    for standID in tqdm(uniqueAllStandsID, disable = disableTQDM):
-        standAgeDict[standID] = statistics.mean(maxAgeDict[standID])
+    standAgeDict = dict(zip(standCoordinatesDict.standIDs.tolist(), meanMaxAge.tolist()))
     return(standAgeDict)
 
-def readingStandManagementUnit(standMapPath, managementUnitsMapPath, disableTQDM):
+def readingStandManagementUnit(standCoordinatesDict, managementUnitsMapPath, disableTQDM, readByBlocks = False):
     '''Assign a management unit (UA) code to each stand. This is not used to define
     management units per say in our landscape, but rather to get the conversion
     values from raw to net merchantable volume harvested, based on data from
     the ministry of forest (the data changes by species and by management unit).
+    The code of a stand is the most common one among its pixels.
+    If readByBlocks is True, the map is read by blocks (see iterateRasterBlocks).
     See coefficientRawToNetVolumes object for more info.'''
     print("Reading stands management units (used for volume conversion)...")
     
-    standData = getRasterData(standMapPath)
-    uniqueAllStandsID = np.unique(standData).tolist()
-    # id 0 for stands = no forests
-    uniqueAllStandsID.remove(0)
-    managementUnitsMap = getRasterData(managementUnitsMapPath)
-    managementUnitDict = dict()
-    # Little trick to use the power of numpy below
-    # We make an array with the pixels we want the value of, and another
-    # with the values
-    pixelCoordinates = np.where(standData != 0)
-    standIDinPixelCoordinates = standData[pixelCoordinates]
-    for standID in tqdm(uniqueAllStandsID, disable = disableTQDM):
-        managementUnitDict[standID] = list()
-    # We get the data for the harvestable pixels
-    managementUnitInPixel = managementUnitsMap[pixelCoordinates]
-    # We fill the dictionnary with the different values of max cohort age for each
-    # pixels in a stand
-    for i in tqdm(range(0, len(pixelCoordinates[0])), disable = disableTQDM):
-        managementUnitDict[standIDinPixelCoordinates[i]].append(managementUnitInPixel[i])
-    # We make a dictionnary containing the mean max age for each stand
-    standManagementUnitDict = dict()
-    for standID in tqdm(uniqueAllStandsID, disable = disableTQDM):
-        standManagementUnitDict[standID] = Counter(managementUnitDict[standID]).most_common(1)[0][0]
+    if readByBlocks:
+        managementUnitsMap = managementUnitsMapPath
+    else:
+        managementUnitsMap = rasterStore.get(managementUnitsMapPath, rasterDataTypes["managementUnits"])
+    mostCommonManagementUnit = zonalStats(standCoordinatesDict, managementUnitsMap, ["mode"])["mode"]
+    standManagementUnitDict = dict(zip(standCoordinatesDict.standIDs.tolist(), mostCommonManagementUnit.tolist()))
     return(standManagementUnitDict)
 
+def readingStandsDisturbanceSeverity(standCoordinatesDict,
+                                     listOfSeverityMapPaths,
+                                     readByBlocks = False,
+                                     unaffectedValue = 1):
+    """
+    Reads the severity maps of disturbance extensions (e.g. Base Fire, Base
+    Wind, BDA) and computes, for each stand, the fraction of its pixels that
+    were affected, the mean severity of the affected pixels and the maximum
+    severity. In these maps, 0 = inactive site, unaffectedValue = not
+    disturbed, and the severity is the value - unaffectedValue.
+    If a pixel is in several maps, its highest severity is kept. The maps that
+    don't exist (no disturbance at this timestep) are skipped.
+    Returns a dictionnary with the keys "affectedFraction", "meanSeverity" and
+    "maximumSeverity", each giving a numpy array with one value per stand in
+    the order of standCoordinatesDict.standIDs.
+    """
+    print("Reading disturbance severity maps...")
+    listOfExistingPaths = list()
+    for severityMapPath in listOfSeverityMapPaths:
+        if os.path.exists(severityMapPath):
+            listOfExistingPaths.append(severityMapPath)
+        else:
+            print("No disturbance severity map at " + severityMapPath + ", skipped.")
+    if len(listOfExistingPaths) == 0:
+        return({"affectedFraction": np.zeros(len(standCoordinatesDict)),
+                "meanSeverity": np.zeros(len(standCoordinatesDict)),
+                "maximumSeverity": np.zeros(len(standCoordinatesDict), dtype = np.int16)})
+    
+    def highestSeverities(listOfValues):
+        # Highest severity of each pixel among the maps (0 if not disturbed)
+        pixelSeverities = np.zeros(len(listOfValues[0]), dtype = np.int16)
+        for values in listOfValues:
+            np.maximum(pixelSeverities, values.astype(np.int16) - unaffectedValue, out = pixelSeverities)
+        return(pixelSeverities)
+    
+    # The number of affected pixels is the number of pixels with a severity
+    # other than 0; the sum of the severities is the one of the affected pixels.
+    stats = ["nonzero", "sum", "max"]
+    if readByBlocks and standCoordinatesDict.rasterPath is not None:
+        strips = ((pixelStandPositions, highestSeverities(listOfValues))
+                  for pixelStandPositions, listOfValues in iterateStandBlocks(standCoordinatesDict,
+                                                                             listOfExistingPaths,
+                                                                             rasterDataTypes["severities"]))
+        severityStats = zonalStatsOfStrips(standCoordinatesDict, strips, stats)
+    else:
+        listOfValues = list()
+        for severityMapPath in listOfExistingPaths:
+            severityMapData = severityMapPath if readByBlocks else getRasterData(severityMapPath, rasterDataTypes["severities"])
+            listOfValues.append(getValuesOfStandPixels(standCoordinatesDict, severityMapData))
+            del severityMapData
+        severityStats = zonalStatsOfStandPixels(standCoordinatesDict, highestSeverities(listOfValues), stats)
+    
+    numberOfAffectedPixels = severityStats["nonzero"]
+    return({"affectedFraction": numberOfAffectedPixels / standCoordinatesDict.sizes,
+            "meanSeverity": np.divide(severityStats["sum"], numberOfAffectedPixels,
+                                      out = np.zeros(len(standCoordinatesDict)), where = numberOfAffectedPixels > 0),
+            "maximumSeverity": severityStats["max"]})
+
+def salvageStands(managementMap,
+                  standCoordinatesDict,
+                  disturbanceSeverityDict,
+                  prescriptionID,
+                  minimumAffectedFraction = 0.5,
+                  minimumSeverity = 1,
+                  takenStands = None):
+    """Puts the given prescription ID (e.g. of a salvage logging prescription)
+    in the management map for the stands with at least minimumAffectedFraction
+    of their pixels affected by a disturbance, with a mean severity of at
+    least minimumSeverity (see readingStandsDisturbanceSeverity).
+    The stands of takenStands (boolean array) are left aside, and the salvaged
+    stands are added to it.
+    Returns the modified management map and the positions of the salvaged stands."""
+    salvagedStands = ((disturbanceSeverityDict["affectedFraction"] >= minimumAffectedFraction) &
+                      (disturbanceSeverityDict["meanSeverity"] >= minimumSeverity))
+    if takenStands is not None:
+        salvagedStands &= ~takenStands
+        takenStands |= salvagedStands
+    salvagedPositions = np.flatnonzero(salvagedStands)
+    managementMap, numberOfPixelsHarvested = harvestStandPositions(managementMap,
+                                                                   salvagedPositions,
+                                                                   standCoordinatesDict,
+                                                                   prescriptionID)
+    return(managementMap, salvagedPositions)
+
 def harvestStands(managementMap, standsList, standCoordinatesDict, prescriptionID):
     """Edits the management map to indicate a list of stands as harvested with
     a given prescription ID. Returns the modified management map."""
     numberOfPixelsHarvested = 0
     for standID in standsList:
-        for pixel in standCoordinatesDict[standID]:
-            managementMap[pixel] = prescriptionID
-            numberOfPixelsHarvested += 1
+        managementMap[standCoordinatesDict[standID]] = prescriptionID
+        numberOfPixelsHarvested += standCoordinatesDict.size(standID)
     return(managementMap, numberOfPixelsHarvested)
 
+def harvestStandPositions(managementMap, standPositions, standCoordinatesDict, prescriptionID):
+    """Same as harvestStands, but for stands given by their positions in
+    standCoordinatesDict.standIDs (like the ones returned by selectStandsForTarget),
+    all edited at once. Returns the modified management map."""
+    selectedStands = np.zeros(len(standCoordinatesDict), dtype = bool)
+    selectedStands[standPositions] = True
+    selectedPixels = standCoordinatesDict.pixelIndices[np.repeat(selectedStands, standCoordinatesDict.sizes)]
+    np.put(managementMap, selectedPixels, prescriptionID)
+    return(managementMap, len(selectedPixels))
+
 def DetermineForestTypesOfStands(standCompositionDict,
                                  standCoordinatesDict,
                                  disableTQDM = True):
@@ -428,13 +1232,18 @@ def DetermineForestTypesOfStands(standCompositionDict,
                          "PICE.RUB","PINU.BAN","PINU.RES","PINU.STR", "THUJ.SPP.ALL",
                          "TSUG.CAN"]
 
+    # We compute the biomass of each type for all stands at once
+    deciduousBiomassPerStand = standCompositionDict.biomassPerStand(deciduousSpecies).tolist()
+    coniferousBiomassPerStand = standCompositionDict.biomassPerStand(coniferousSpecies).tolist()
+    positionOfStands = dict(zip(standCompositionDict.uniqueStandIDs.tolist(), range(len(standCompositionDict))))
+
     dictForestTypes = dict()
     for standID in tqdm(standCoordinatesDict.keys(), disable = disableTQDM):
         if standID not in standCompositionDict:
             dictForestTypes[standID] = "none"
         else:
-            deciduousBiomass = GetBiomassInstand(standCompositionDict, standID, deciduousSpecies)
-            coniferousBiomass = GetBiomassInstand(standCompositionDict, standID, coniferousSpecies)
+            deciduousBiomass = deciduousBiomassPerStand[positionOfStands[standID]]
+            coniferousBiomass = coniferousBiomassPerStand[positionOfStands[standID]]
             totalBiomass = deciduousBiomass + coniferousBiomass
             if deciduousBiomass/totalBiomass > 0.7:
                 dictForestTypes[standID] = "F"
@@ -445,76 +1254,714 @@ def DetermineForestTypesOfStands(standCompositionDict,
                 
     return(dictForestTypes)
 
+def compileCohortRemovalFractions(cohortRemoved, speciesNames, numberOfAges):
+    """Turns the cohorts removed by a prescription, as read by
+    harvestParameterFileParser (species -> "All" or [[minimum age, maximum age,
+    % of biomass removed], ...], and "_Mode" -> ClearCut, SpeciesList or
+    PlantOnly), into a table of the fraction of biomass removed for each
+    species (rows, in the order of speciesNames) and age (columns, from 0 to
+    numberOfAges - 1)."""
+    removalFractions = np.zeros((len(speciesNames), numberOfAges), dtype = np.float32)
+    if cohortRemoved.get("_Mode") == "ClearCut":
+        removalFractions[:, :] = 1
+        return(removalFractions)
+    for speciesCode, species in enumerate(speciesNames):
+        if species not in cohortRemoved:
+            continue
+        if cohortRemoved[species] == "All":
+            removalFractions[speciesCode, :] = 1
+        else:
+            for minimumAge, maximumAge, percentage in cohortRemoved[species]:
+                removalFractions[speciesCode, minimumAge:maximumAge + 1] = percentage / 100
+    return(removalFractions)
+
+def computeRemovableBiomass(standCompositionDict,
+                            standCoordinatesDict,
+                            prescriptionParameters,
+                            secondPass = False):
+    """
+    Computes the biomass (in Mg/ha summed over the pixels of the stand, like
+    in the CohortTable) that each prescription would remove from each stand,
+    according to the cohorts removed written in the harvest parameter file.
+    If secondPass is True, the cohorts removed by the second pass of the
+    prescriptions with a SingleRepeat are used instead (prescriptions without
+    it remove nothing).
+    Returns a 2D array with one row per stand (in the order of
+    standCoordinatesDict.standIDs) and one column per prescription, and the
+    list of the names of the prescriptions of the columns.
+    """
+    print("Computing the biomass removed by each prescription in each stand...")
+    listOfPrescriptions = [prescription for prescription in prescriptionParameters
+                           if prescription != "PlantingPrescriptions" and prescription != "_MaxPrescriptionID"]
+    listOfCohortsRemoved = [prescriptionParameters[prescription].get("CohortRemoved", dict()) for prescription in listOfPrescriptions]
+    if "PlantingPrescriptions" in prescriptionParameters:
+        for plantingPrescription in prescriptionParameters["PlantingPrescriptions"]:
+            listOfPrescriptions.append(plantingPrescription)
+            listOfCohortsRemoved.append(prescriptionParameters["PlantingPrescriptions"][plantingPrescription].get("CohortRemoved", dict()))
+    if secondPass:
+        listOfCohortsRemoved = [cohortRemoved.get("SingleRepeat", dict()) for cohortRemoved in listOfCohortsRemoved]
+    
+    numberOfAges = int(standCompositionDict.ages.max()) + 1 if len(standCompositionDict.ages) > 0 else 1
+    # Stands without cohorts are not in the CohortTable, and stay at 0
+    removableBiomass = np.zeros((len(standCoordinatesDict), len(listOfPrescriptions)))
+    positionsOfStands = standCoordinatesDict.positionsOf(standCompositionDict.uniqueStandIDs)
+    for column, cohortRemoved in enumerate(listOfCohortsRemoved):
+        removalFractions = compileCohortRemovalFractions(cohortRemoved,
+                                                         standCompositionDict.speciesNames,
+                                                         numberOfAges)
+        removableBiomass[positionsOfStands, column] = standCompositionDict.removedBiomassPerStand(removalFractions)
+    return(removableBiomass, listOfPrescriptions)
+
+def selectStandsForTarget(standScores,
+                          eligibleStands,
+                          standContributions,
+                          target,
+                          stopAfterTarget = True):
+    """
+    Selects the eligible stands with the highest scores until the sum of their
+    contributions (e.g. area, biomass or volume harvested) reaches the target.
+    All of the arrays have one value per stand (e.g. in the order of
+    standCoordinatesDict.standIDs).
+    If stopAfterTarget is True, the stand that makes the sum reach the target
+    is selected (the target is exceeded a bit); if False, the selection stops
+    just before it (the target is never exceeded).
+    Returns the positions of the selected stands, from highest to lowest score,
+    and the sum of their contributions.
+    """
+    eligiblePositions = np.flatnonzero(eligibleStands)
+    # The stable sort keeps the order of the stands in case of equal scores
+    rankedPositions = eligiblePositions[np.argsort(-np.asarray(standScores)[eligiblePositions], kind = "stable")]
+    cumulatedContributions = np.cumsum(np.asarray(standContributions, dtype = np.float64)[rankedPositions])
+    if target <= 0:
+        # The target is already reached
+        numberOfSelectedStands = 0
+    elif stopAfterTarget:
+        numberOfSelectedStands = min(int(np.searchsorted(cumulatedContributions, target, side = "left")) + 1,
+                                     len(rankedPositions))
+    else:
+        numberOfSelectedStands = int(np.searchsorted(cumulatedContributions, target, side = "right"))
+    totalContribution = float(cumulatedContributions[numberOfSelectedStands - 1]) if numberOfSelectedStands > 0 else 0.0
+    return(rankedPositions[:numberOfSelectedStands], totalContribution)
+
+def allocateTargets(listOfTargets, numberOfStands, takenStands = None):
+    """
+    Fills several targets one after the other with selectStandsForTarget; each
+    target can only use the stands that were not taken by the ones before.
+    listOfTargets is a list of dictionnaries with the keys "prescription",
+    "scores", "eligible", "contributions", "target" and, optionally,
+    "stopAfterTarget" (True by default).
+    takenStands is a boolean array of the stands that can't be used at all
+    (e.g. stands already harvested by a repeated prescription); it is updated.
+    Returns a dictionnary giving the positions of the stands selected for each
+    prescription, and a dictionnary with the amount reached for each of them.
+    """
+    if takenStands is None:
+        takenStands = np.zeros(numberOfStands, dtype = bool)
+    selectedStandsDict = dict()
+    amountReachedDict = dict()
+    for target in listOfTargets:
+        selectedPositions, amountReached = selectStandsForTarget(target["scores"],
+                                                                 np.asarray(target["eligible"], dtype = bool) & ~takenStands,
+                                                                 target["contributions"],
+                                                                 target["target"],
+                                                                 target.get("stopAfterTarget", True))
+        takenStands[selectedPositions] = True
+        selectedStandsDict[target["prescription"]] = selectedPositions
+        amountReachedDict[target["prescription"]] = amountReached
+    return(selectedStandsDict, amountReachedDict)
+
+def _contributionsOfPairs(constraint, pairStandPositions, pairColumns, listOfPrescriptions):
+    """Returns the contribution of each (stand, prescription) pair to a
+    constraint of optimizeStandPrescriptions (0 for the pairs it doesn't concern)."""
+    contributions = np.asarray(constraint["contributions"], dtype = np.float64)
+    if contributions.ndim == 1:
+        pairContributions = contributions[pairStandPositions]
+    else:
+        pairContributions = contributions[pairStandPositions, pairColumns]
+    concernedPairs = np.ones(len(pairStandPositions), dtype = bool)
+    if constraint.get("prescriptions") is not None:
+        concernedPairs &= np.isin(pairColumns, [listOfPrescriptions.index(prescription) for prescription in constraint["prescriptions"]])
+    if constraint.get("stands") is not None:
+        concernedPairs &= np.asarray(constraint["stands"], dtype = bool)[pairStandPositions]
+    return(np.where(concernedPairs, pairContributions, 0))
+
+def _greedyStandPrescriptions(pairValues, pairStandPositions, pairColumns, pairContributionsList, listOfConstraints, numberOfStands):
+    """Greedy fallback of optimizeStandPrescriptions : the constraints with
+    a minimum are filled one after the other with the pairs of highest value,
+    leaving out the pairs that would exceed the maximums of the constraints.
+    Returns a boolean array of the selected pairs."""
+    selectedPairs = np.zeros(len(pairValues), dtype = bool)
+    takenStands = np.zeros(numberOfStands, dtype = bool)
+    amountsReached = np.zeros(len(listOfConstraints))
+    for constraintNumber, constraint in enumerate(listOfConstraints):
+        if constraint.get("minimum") is None:
+            continue
+        # The pairs concerned by the constraint, on free stands, from highest to lowest value
+        candidatePairs = np.flatnonzero((pairContributionsList[constraintNumber] != 0) & ~takenStands[pairStandPositions])
+        candidatePairs = candidatePairs[np.argsort(-pairValues[candidatePairs], kind = "stable")]
+        # Only the best pair of each stand is kept
+        candidatePairs = candidatePairs[np.sort(np.unique(pairStandPositions[candidatePairs], return_index = True)[1])]
+        # We leave out the pairs that would make a maximum be exceeded
+        for otherConstraintNumber, otherConstraint in enumerate(listOfConstraints):
+            if otherConstraint.get("maximum") is not None:
+                cumulatedAmounts = amountsReached[otherConstraintNumber] + np.cumsum(pairContributionsList[otherConstraintNumber][candidatePairs])
+                candidatePairs = candidatePairs[cumulatedAmounts <= otherConstraint["maximum"]]
+        # And we stop once the minimum is reached
+        cumulatedAmounts = amountsReached[constraintNumber] + np.cumsum(pairContributionsList[constraintNumber][candidatePairs])
+        numberOfSelectedPairs = min(int(np.searchsorted(cumulatedAmounts, constraint["minimum"], side = "left")) + 1,
+                                    len(candidatePairs))
+        candidatePairs = candidatePairs[:numberOfSelectedPairs]
+        selectedPairs[candidatePairs] = True
+        takenStands[pairStandPositions[candidatePairs]] = True
+        for otherConstraintNumber in range(len(listOfConstraints)):
+            amountsReached[otherConstraintNumber] += pairContributionsList[otherConstraintNumber][candidatePairs].sum()
+    return(selectedPairs)
+
+def optimizeStandPrescriptions(standValues,
+                               eligibleStands,
+                               listOfPrescriptions,
+                               listOfConstraints,
+                               timeLimit = 60):
+    """
+    Chooses the prescription to apply to each stand (or none) by solving a
+    mixed-integer linear problem with scipy.optimize.milp, rather than by
+    filling the targets one after the other like allocateTargets.
+    - standValues and eligibleStands are 2D arrays with one row per stand
+      (e.g. in the order of standCoordinatesDict.standIDs) and one column per
+      prescription of listOfPrescriptions (e.g. like removableBiomass and
+      removableBiomassPrescriptions, see computeRemovableBiomass). The sum of
+      the values of the selected stands is maximized : positive values make
+      the solver harvest as much as the maximums allow, negative values (costs)
+      make it harvest just what is needed to reach the minimums.
+    - listOfConstraints is a list of dictionnaries with the keys
+      "contributions" (2D array like standValues, or 1D array with one value
+      per stand, like the area of the stands), "minimum" and/or "maximum", and
+      optionally "prescriptions" (list of the prescriptions concerned, all by
+      default) and "stands" (boolean array of the stands concerned, e.g. the
+      stands of a management unit for a cap by unit).
+    If no solution is found in timeLimit seconds (or if scipy is too old to
+    have milp), a greedy selection is made instead (see _greedyStandPrescriptions).
+    Returns a dictionnary giving the positions of the stands selected for each
+    prescription (like allocateTargets), and the status of the solver.
+    """
+    print("Optimizing the prescriptions of the stands...")
+    standValues = np.asarray(standValues, dtype = np.float64)
+    numberOfStands = standValues.shape[0]
+    # The variables of the problem are the (stand, prescription) pairs allowed
+    pairStandPositions, pairColumns = np.nonzero(np.asarray(eligibleStands, dtype = bool))
+    pairValues = standValues[pairStandPositions, pairColumns]
+    pairContributionsList = [_contributionsOfPairs(constraint, pairStandPositions, pairColumns, listOfPrescriptions)
+                             for constraint in listOfConstraints]
+    
+    selectedPairs = None
+    if len(pairValues) > 0 and hasattr(optimize, "milp"):
+        # One prescription at most per stand
+        constraintMatrices = [sparse.csr_matrix((np.ones(len(pairValues)), (pairStandPositions, np.arange(len(pairValues)))),
+                                                shape = (numberOfStands, len(pairValues)))]
+        lowerBounds = [np.zeros(numberOfStands)]
+        upperBounds = [np.ones(numberOfStands)]
+        for constraintNumber, constraint in enumerate(listOfConstraints):
+            constraintMatrices.append(sparse.csr_matrix(pairContributionsList[constraintNumber].reshape(1, -1)))
+            lowerBounds.append([constraint["minimum"] if constraint.get("minimum") is not None else -np.inf])
+            upperBounds.append([constraint["maximum"] if constraint.get("maximum") is not None else np.inf])
+        result = optimize.milp(-pairValues,
+                               integrality = np.ones(len(pairValues)),
+                               bounds = optimize.Bounds(0, 1),
+                               constraints = optimize.LinearConstraint(sparse.vstack(constraintMatrices, format = "csr"),
+                                                                       np.concatenate(lowerBounds),
+                                                                       np.concatenate(upperBounds)),
+                               options = {"time_limit": timeLimit})
+        solverStatus = result.message
+        if result.x is not None:
+            selectedPairs = result.x > 0.5
+    else:
+        solverStatus = "scipy.optimize.milp is not available" if len(pairValues) > 0 else "No eligible stands"
+    if selectedPairs is None:
+        print("No optimal solution found (" + str(solverStatus) + "); using a greedy selection instead.")
+        selectedPairs = _greedyStandPrescriptions(pairValues, pairStandPositions, pairColumns,
+                                                  pairContributionsList, listOfConstraints, numberOfStands)
+        solverStatus = "Greedy fallback : " + str(solverStatus)
+    
+    selectedStandsDict = dict()
+    for column, prescription in enumerate(listOfPrescriptions):
+        selectedStandsDict[prescription] = pairStandPositions[selectedPairs & (pairColumns == column)]
+    return(selectedStandsDict, solverStatus)
+
+class RepeatedPrescriptionSchedule:
+    """
+    Keeps track of the stands that will be harvested again by a prescription
+    with a SingleRepeat or MultipleRepeat, between the timesteps.
+    The stands are stored by the timestep at which they are due, in a .npy
+    file per timestep in folderPath (one row per stand, with the stand ID and
+    the prescription ID). Getting the stands due at a timestep only reads the
+    files of this timestep, and scheduling stands only rewrites the files of
+    the timesteps where they are added.
+    WARNING : the stands are kept with the ID of the prescription that was
+    applied to them. For a MultipleRepeat, it can be applied again as is; for
+    a SingleRepeat, applying it again would redo its first pass. The second
+    pass (the CohortsRemoved after "SingleRepeat" in the harvest file, see
+    computeRemovableBiomass with secondPass = True) must be given to Biomass
+    Harvest as a prescription of its own.
+    """
+    entryDataType = np.dtype([("standID", np.int32), ("prescriptionID", np.int16)])
+    
+    def __init__(self, folderPath):
+        self.folderPath = folderPath
+        if not os.path.exists(folderPath):
+            os.makedirs(folderPath)
+    
+    def _bucketPath(self, dueTimestep):
+        return(os.path.join(self.folderPath, "due-" + str(dueTimestep) + ".npy"))
+    
+    def dueTimesteps(self):
+        """Returns the sorted list of the timesteps at which stands are due."""
+        return(sorted(int(fileName[len("due-"):-len(".npy")]) for fileName in os.listdir(self.folderPath)
+                      if fileName.startswith("due-") and fileName.endswith(".npy")))
+    
+    def _readBucket(self, dueTimestep):
+        if not os.path.exists(self._bucketPath(dueTimestep)):
+            return(np.zeros(0, dtype = self.entryDataType))
+        return(np.load(self._bucketPath(dueTimestep)))
+    
+    def add(self, standIDs, prescriptionIDs, dueTimesteps):
+        """Schedules the stands to be harvested again with the given
+        prescription IDs at the given timesteps (arrays, or single values)."""
+        standIDs = np.atleast_1d(np.asarray(standIDs))
+        entries = np.zeros(len(standIDs), dtype = self.entryDataType)
+        entries["standID"] = standIDs
+        entries["prescriptionID"] = np.broadcast_to(prescriptionIDs, len(standIDs))
+        dueTimesteps = np.broadcast_to(dueTimesteps, len(standIDs))
+        for dueTimestep in np.unique(dueTimesteps).tolist():
+            bucket = np.concatenate((self._readBucket(dueTimestep), entries[dueTimesteps == dueTimestep]))
+            # We write in a temporary file first, so that an interrupted run
+            # can't leave an incomplete file behind.
+            temporaryPath = self._bucketPath(dueTimestep) + "-" + str(os.getpid()) + ".tmp"
+            with open(temporaryPath, "wb") as bucketFile:
+                np.save(bucketFile, bucket)
+            os.replace(temporaryPath, self._bucketPath(dueTimestep))
+    
+    @staticmethod
+    def repeatParametersOfPrescriptionIDs(prescriptionParameters):
+        """Returns a dictionnary giving the repeat mode and repeat frequency
+        of each prescription ID that has a repeat."""
+        repeatParametersOfIDs = dict()
+        for parameters in list(prescriptionParameters.values()) + list(prescriptionParameters.get("PlantingPrescriptions", dict()).values()):
+            if isinstance(parameters, dict) and parameters.get("RepeatMode") in ("SingleRepeat", "MultipleRepeat"):
+                repeatParametersOfIDs[parameters["PrescriptionID"]] = (parameters["RepeatMode"], parameters["RepeatFrequency"])
+        return(repeatParametersOfIDs)
+    
+    def due(self, timestep, prescriptionParameters = None, repeatModes = ("SingleRepeat", "MultipleRepeat")):
+        """Returns the stand IDs and prescription IDs of the stands due at the
+        given timestep, or before it if they were not removed (see removeDue).
+        If prescriptionParameters is given, only the stands of prescriptions
+        with a repeat mode in repeatModes are returned."""
+        entries = [self._readBucket(dueTimestep) for dueTimestep in self.dueTimesteps() if dueTimestep <= timestep]
+        if len(entries) == 0:
+            entries = [np.zeros(0, dtype = self.entryDataType)]
+        entries = np.concatenate(entries)
+        if prescriptionParameters is not None:
+            repeatParametersOfIDs = self.repeatParametersOfPrescriptionIDs(prescriptionParameters)
+            selectedIDs = [prescriptionID for prescriptionID in repeatParametersOfIDs if repeatParametersOfIDs[prescriptionID][0] in repeatModes]
+            entries = entries[np.isin(entries["prescriptionID"], selectedIDs)]
+        return(entries["standID"], entries["prescriptionID"])
+    
+    def removeDue(self, timestep):
+        """Removes the stands due at the given timestep or before it, once they
+        have been dealt with."""
+        for dueTimestep in self.dueTimesteps():
+            if dueTimestep <= timestep:
+                os.remove(self._bucketPath(dueTimestep))
+    
+    def clear(self):
+        """Removes all of the stands scheduled (e.g. at the start of a new simulation)."""
+        self.removeDue(float("inf"))
+    
+    def scheduleRepeats(self, standIDs, prescriptionIDs, timestep, prescriptionParameters, repeatModes = ("SingleRepeat", "MultipleRepeat")):
+        """Schedules the stands harvested at this timestep with prescriptions
+        that have a repeat mode in repeatModes, at this timestep + the
+        RepeatFrequency of the prescription.
+        Use repeatModes = ("MultipleRepeat",) for the stands that were due at
+        this timestep, as a SingleRepeat only happens once."""
+        standIDs = np.atleast_1d(np.asarray(standIDs))
+        prescriptionIDs = np.broadcast_to(prescriptionIDs, len(standIDs))
+        repeatParametersOfIDs = self.repeatParametersOfPrescriptionIDs(prescriptionParameters)
+        for prescriptionID in np.unique(prescriptionIDs).tolist():
+            if prescriptionID in repeatParametersOfIDs and repeatParametersOfIDs[prescriptionID][0] in repeatModes:
+                self.add(standIDs[prescriptionIDs == prescriptionID],
+                         prescriptionID,
+                         timestep + repeatParametersOfIDs[prescriptionID][1])
+
+class StandAdjacency:
+    """
+    Compact graph of the neighbors of each stand, stored like a CSR sparse
+    matrix : the neighbors of all stands are in a single array, sorted by
+    stand, with an array of offsets telling where the neighbors of each
+    stand start and end. For each pair of neighbors, we also keep the
+    number of pairs of adjacent pixels between the two stands (the length
+    of their shared boundary, in pixels), which can be used to weight the
+    propagation of harvests.
+    
+    It can be used like the old standNeighboursDict : standAdjacency[standID]
+    returns the array of the IDs of the neighbors of the stand.
+    """
+    def __init__(self, standIDs, offsets, neighbourIDs, boundaryLengths):
+        self.standIDs = standIDs
+        self.offsets = offsets
+        self.neighbourIDs = neighbourIDs
+        self.boundaryLengths = boundaryLengths
+        # Positions of the neighbors in self.standIDs, used to propagate harvests
+        self.neighbourPositions = np.searchsorted(self.standIDs, self.neighbourIDs)
+        self._positions = dict(zip(self.standIDs.tolist(), range(len(self.standIDs))))
+    
+    def sharedBoundaries(self, standID):
+        """Returns the number of pairs of adjacent pixels between the stand and
+        each of its neighbors (in the same order as standAdjacency[standID])."""
+        position = self._positions[standID]
+        return(self.boundaryLengths[self.offsets[position]:self.offsets[position + 1]])
+    
+    def keys(self):
+        return(self._positions.keys())
+    
+    def items(self):
+        for standID in self._positions:
+            yield (standID, self[standID])
+    
+    def __getitem__(self, standID):
+        position = self._positions[standID]
+        return(self.neighbourIDs[self.offsets[position]:self.offsets[position + 1]])
+    
+    def __contains__(self, standID):
+        return(standID in self._positions)
+    
+    def __iter__(self):
+        return(iter(self._positions))
+    
+    def __len__(self):
+        return(len(self._positions))
+
 def readingStandsNeighbors(standRasterDataAll,
                            standCoordinatesDict,
-                           disableTQDM = True):
-    '''Reads the neighbors of each stand by looking at the surrounding
-    pixels of those of the stands, and getting their stand ID. Returns a dictionnary
-    with the list of neighbors's stand ID for each stand.'''
+                           disableTQDM = True,
+                           connectivity = 8):
+    '''Reads the neighbors of each stand by comparing the stands raster with
+    copies of itself shifted by one pixel in each direction : every pair of
+    adjacent pixels with two different stand IDs makes the two stands neighbors.
+    connectivity can be 8 (pixels touching by a side or a corner are adjacent)
+    or 4 (only pixels touching by a side).
+    standRasterDataAll can also be the path of the stands raster, to read it
+    by blocks (see iterateRasterBlocks).
+    Returns a StandAdjacency with the neighbors's stand ID for each stand.'''
     print("Reading stand neighbors...")
     
-    # Making a dictionnary which tells what stand is a neighbor of which one.
-    # We only need it for harvestable stands, since this is for the propagation
-    # of cuts.
-    standNeighboursDict = dict()
-    minXRange = range(standRasterDataAll.shape[0])[0]
-    maxXRange = range(standRasterDataAll.shape[0])[-1]
-    minYRange = range(standRasterDataAll.shape[1])[0]
-    maxYRange = range(standRasterDataAll.shape[1])[-1]
-    for standID in tqdm(standCoordinatesDict.keys(), disable = disableTQDM):
-        listOfNeighbouringStands = list()
-        for pixel in standCoordinatesDict[standID]:
-            listOfStandsAroundPixel = list()
-            # We look at the 8 neighbors of the pixel, if not out of range,
-            # to try to detect another stand number
-            # First, we prepare the ranges around which we'll loop, and make sure
-            # we're not out of bounds
-            xMinus1 = max(pixel[0] - 1, minXRange)
-            xPlus1 = min(pixel[0] + 1, maxXRange)
-            yMinus1 = max(pixel[1] - 1, minYRange)
-            yPlus1 = min(pixel[1] + 1, maxYRange)
-            # Now, we loop to find values
-            for x in [xMinus1, pixel[0], xPlus1]:
-                for y in [yMinus1, pixel[1], yPlus1]:
-                    listOfStandsAroundPixel.append(standRasterDataAll[(x, y)])
-            uniqueNeighbouringStands = set(listOfStandsAroundPixel)
-            # We remove mentions of the present stand and of the value 0
-            uniqueNeighbouringStands.discard(standID)
-            uniqueNeighbouringStands.discard(0)
-            listOfNeighbouringStands.extend(list(uniqueNeighbouringStands))
-        # We add the resulting unique standID that we found as neighbors to this stand
-        standNeighboursDict[standID] = set(listOfNeighbouringStands)
-    return(standNeighboursDict)
+    if connectivity == 8:
+        # We only need half of the shifts, as each one gives the pairs both ways
+        shifts = [(0, 1), (1, 0), (1, 1), (1, -1)]
+    elif connectivity == 4:
+        shifts = [(0, 1), (1, 0)]
+    else:
+        raise ValueError("The connectivity for the stand neighbors must be 4 or 8, not " + str(connectivity))
+    
+    numberOfStands = len(standCoordinatesDict)
+    pairKeys = list()
+    # We compare the pixels strip by strip if we read the raster by blocks, or
+    # all at once if not. The strips contain the row below them, as it's needed
+    # to compare their last row with the next one.
+    if isinstance(standRasterDataAll, str):
+        strips = iterateRasterBlocks(standRasterDataAll, overlapRows = 1)
+    else:
+        strips = [(0, standRasterDataAll.shape[0], standRasterDataAll)]
+    for firstRow, numberOfStripRows, stripData in tqdm(strips, disable = disableTQDM):
+        numberOfRows, numberOfColumns = stripData.shape
+        for rowShift, columnShift in shifts:
+            # Pixels of the strip, and the ones at (rowShift, columnShift) of them
+            numberOfPixelRows = min(numberOfStripRows, numberOfRows - rowShift)
+            pixels = stripData[0:numberOfPixelRows,
+                               max(0, -columnShift):numberOfColumns - max(0, columnShift)]
+            shiftedPixels = stripData[rowShift:rowShift + numberOfPixelRows,
+                                      max(0, columnShift):numberOfColumns - max(0, -columnShift)]
+            # We only keep the pairs of different stands, without the value 0 (no forest)
+            isBoundary = (pixels != shiftedPixels) & (pixels != 0) & (shiftedPixels != 0)
+            positionsA = np.searchsorted(standCoordinatesDict.standIDs, pixels[isBoundary]).astype(np.int64)
+            positionsB = np.searchsorted(standCoordinatesDict.standIDs, shiftedPixels[isBoundary]).astype(np.int64)
+            pairKeys.append(positionsA * numberOfStands + positionsB)
+            pairKeys.append(positionsB * numberOfStands + positionsA)
+    
+    # Sorting the unique pairs by their first stand gives the CSR structure
+    uniquePairKeys, boundaryLengths = np.unique(np.concatenate(pairKeys + [np.zeros(0, dtype = np.int64)]), return_counts = True)
+    pairStandPositions = uniquePairKeys // max(numberOfStands, 1)
+    offsets = np.append(0, np.cumsum(np.bincount(pairStandPositions, minlength = numberOfStands)))
+    neighbourIDs = standCoordinatesDict.standIDs[uniquePairKeys % max(numberOfStands, 1)]
+    return(StandAdjacency(standCoordinatesDict.standIDs, offsets, neighbourIDs, boundaryLengths))
+    
+def eligibleStandsForPrescription(prescription,
+                                  prescriptionParameters,
+                                  standCoordinatesDict,
+                                  standAgeDict):
+    """Returns a boolean array telling, for each stand (in the order of
+    standCoordinatesDict.standIDs), if its age is between the minimum and
+    maximum stand age of the prescription, so that a harvest can propagate to it."""
+    standAges = np.array([standAgeDict[standID] for standID in standCoordinatesDict.standIDs.tolist()])
+    return((standAges > prescriptionParameters[prescription]["MinimumStandAge"]) &
+           (standAges < prescriptionParameters[prescription]["MaximumStandAge"]))
+
+def growHarvestPatch(seedStand,
+                     minimumPatchSize,
+                     maximumPatchSize,
+                     standNeighboursDict,
+                     standCoordinatesDict,
+                     eligibleStands,
+                     standScores = None):
+    """
+    Grows a harvest patch from a seed stand to the neighbouring stands, in
+    breadth-first order, through the stands that are eligible (boolean array
+    with one value per stand in the order of standCoordinatesDict.standIDs,
+    see eligibleStandsForPrescription). The seed is always the first stand.
+    The patch stops growing when its size reaches maximumPatchSize, when the
+    next stand would make it bigger than maximumPatchSize, or when there are no
+    more eligible neighbours. If it's then smaller than minimumPatchSize, the
+    patch is abandoned (no stands are returned).
+    If standScores is given (array with one score per stand, in the same order,
+    e.g. their merchantable biomass), the patch grows best-first instead : it
+    always takes the neighbour with the highest score, and skips the ones that
+    would make it too big to keep filling it up to maximumPatchSize.
+    Returns the array of the stand IDs in the patch, and the size of the patch.
+    """
+    # TO UPDATE : Surface harvested here is dealt in pixels. But in harvest parameter
+    # file, might be in different units than pixel. See how to adapt to that. Need cell length ?
+    standAreas = standCoordinatesDict.sizes
+    neighbourOffsets = standNeighboursDict.offsets
+    neighbourPositions = standNeighboursDict.neighbourPositions
+    seedPosition = int(standCoordinatesDict.positionsOf(seedStand))
+    patchPositions = list()
+    patchSize = 0
+    # Stands already put in the frontier (or in the patch)
+    visited = {seedPosition}
+    if standScores is None:
+        frontier = deque([seedPosition])
+    else:
+        # Heap of (-score, order of discovery, stand) : the best stand comes out
+        # first, and the first one found in case of equal scores.
+        frontier = [(0, 0, seedPosition)]
+        numberOfStandsFound = 1
+    while patchSize < maximumPatchSize and len(frontier) > 0:
+        if standScores is None:
+            focusPosition = frontier.popleft()
+            # If we overeach the maximum surface, we stop here.
+            if patchSize + standAreas[focusPosition] > maximumPatchSize:
+                break
+        else:
+            focusPosition = heapq.heappop(frontier)[2]
+            # If this stand is too big, we try the next best ones
+            if patchSize + standAreas[focusPosition] > maximumPatchSize:
+                continue
+        patchPositions.append(focusPosition)
+        patchSize += int(standAreas[focusPosition])
+        for neighbourPosition in neighbourPositions[neighbourOffsets[focusPosition]:neighbourOffsets[focusPosition + 1]].tolist():
+            if neighbourPosition not in visited and eligibleStands[neighbourPosition]:
+                visited.add(neighbourPosition)
+                if standScores is None:
+                    frontier.append(neighbourPosition)
+                else:
+                    heapq.heappush(frontier, (-standScores[neighbourPosition], numberOfStandsFound, neighbourPosition))
+                    numberOfStandsFound += 1
+    if patchSize < minimumPatchSize:
+        return(standCoordinatesDict.standIDs[:0], 0)
+    return(standCoordinatesDict.standIDs[patchPositions], patchSize)
+
+def growHarvestPatches(seedStands,
+                       minimumPatchSize,
+                       maximumPatchSize,
+                       standNeighboursDict,
+                       standCoordinatesDict,
+                       eligibleStands,
+                       claimedStands = None):
+    """
+    Grows harvest patches from many seed stands at once, like growHarvestPatch
+    but without letting two patches take the same stand.
+    All patches grow at the same time, one ring of neighbours after the other.
+    When several patches reach the same stand in the same ring, the patch
+    whose seed comes first in seedStands gets it : sort the seeds by priority
+    before calling this function. A seed that is already claimed (e.g. by an
+    earlier seed) gives an empty patch.
+    claimedStands is a boolean array (one value per stand in the order of
+    standCoordinatesDict.standIDs) of the stands that can't be taken anymore;
+    it's updated with the stands of the new patches, so it can be shared
+    between several calls (e.g. for different prescriptions).
+    Patches smaller than minimumPatchSize at the end are abandoned, and their
+    stands are freed.
+    Returns an array with, for each stand, the index in seedStands of the patch
+    that took it (-1 if none), and an array with the size of each patch.
+    """
+    standAreas = standCoordinatesDict.sizes
+    neighbourOffsets = standNeighboursDict.offsets
+    neighbourPositions = standNeighboursDict.neighbourPositions
+    numberOfStands = len(standAreas)
+    if claimedStands is None:
+        claimedStands = np.zeros(numberOfStands, dtype = bool)
+    seedPositions = standCoordinatesDict.positionsOf(np.asarray(seedStands))
+    numberOfPatches = len(seedPositions)
+    patchLabels = np.full(numberOfStands, -1, dtype = np.int64)
+    patchSizes = np.zeros(numberOfPatches, dtype = np.int64)
+    
+    # We start with the seeds : only the first patch gets a seed given several times
+    uniqueSeedPositions, firstPatchOfSeed = np.unique(seedPositions, return_index = True)
+    isStartingPatch = np.zeros(numberOfPatches, dtype = bool)
+    isStartingPatch[firstPatchOfSeed] = True
+    isStartingPatch &= ~claimedStands[seedPositions]
+    isStartingPatch &= standAreas[seedPositions] <= maximumPatchSize
+    frontierPatches = np.flatnonzero(isStartingPatch)
+    frontierPositions = seedPositions[frontierPatches]
+    patchLabels[frontierPositions] = frontierPatches
+    claimedStands[frontierPositions] = True
+    patchSizes[frontierPatches] = standAreas[frontierPositions]
+    isGrowing = isStartingPatch.copy()
+    
+    while len(frontierPositions) > 0:
+        # Neighbours of the stands of the frontier, in the order in which they are found
+        numberOfNeighbours = neighbourOffsets[frontierPositions + 1] - neighbourOffsets[frontierPositions]
+        candidatePatches = np.repeat(frontierPatches, numberOfNeighbours)
+        candidatePositions = neighbourPositions[np.repeat(neighbourOffsets[frontierPositions], numberOfNeighbours)
+                                                + np.arange(numberOfNeighbours.sum())
+                                                - np.repeat(np.cumsum(numberOfNeighbours) - numberOfNeighbours, numberOfNeighbours)]
+        isCandidate = (~claimedStands[candidatePositions]) & eligibleStands[candidatePositions] & isGrowing[candidatePatches]
+        candidatePatches = candidatePatches[isCandidate]
+        candidatePositions = candidatePositions[isCandidate]
+        discoveryOrder = np.arange(len(candidatePositions))
+        # Each stand goes to the first patch that found it
+        order = np.lexsort((discoveryOrder, candidatePatches, candidatePositions))
+        isWinner = np.ones(len(order), dtype = bool)
+        isWinner[1:] = candidatePositions[order][1:] != candidatePositions[order][:-1]
+        winners = order[isWinner]
+        # Each patch takes its stands in the order it found them, until the
+        # next one would make it bigger than the maximum size; then it stops growing.
+        winners = winners[np.lexsort((discoveryOrder[winners], candidatePatches[winners]))]
+        winnerPatches = candidatePatches[winners]
+        winnerPositions = candidatePositions[winners]
+        cumulativeAreas = np.cumsum(standAreas[winnerPositions])
+        isFirstOfPatch = np.ones(len(winners), dtype = bool)
+        isFirstOfPatch[1:] = winnerPatches[1:] != winnerPatches[:-1]
+        areaBeforePatch = np.repeat(cumulativeAreas[isFirstOfPatch] - standAreas[winnerPositions][isFirstOfPatch],
+                                    np.diff(np.append(np.flatnonzero(isFirstOfPatch), len(winners))))
+        isAccepted = patchSizes[winnerPatches] + cumulativeAreas - areaBeforePatch <= maximumPatchSize
+        isGrowing[winnerPatches[~isAccepted]] = False
+        frontierPatches = winnerPatches[isAccepted]
+        frontierPositions = winnerPositions[isAccepted]
+        patchLabels[frontierPositions] = frontierPatches
+        claimedStands[frontierPositions] = True
+        patchSizes += np.bincount(frontierPatches, weights = standAreas[frontierPositions], minlength = numberOfPatches).astype(np.int64)
     
+    # Patches that are too small are abandoned
+    isAbandoned = np.zeros(numberOfPatches + 1, dtype = bool)
+    isAbandoned[:-1] = patchSizes < minimumPatchSize
+    # (the last value is for the stands without patch, labelled -1)
+    standsToFree = isAbandoned[patchLabels] & (patchLabels >= 0)
+    claimedStands[standsToFree] = False
+    patchLabels[standsToFree] = -1
+    patchSizes[isAbandoned[:-1]] = 0
+    return(patchLabels, patchSizes)
+
 def standHarvestPropagation(standID,
                             prescription,
                             prescriptionParameters,
                             standNeighboursDict,
                             standCoordinatesDict,
-                            standAgeDict):
+                            standAgeDict,
+                            eligibleStands = None,
+                            standScores = None):
     """
     Propagate a harvest prescription from a stand to the neigbouring stands,
     depending on the selection criteria + min/max harvest size for the
-    prescription.
+    prescription (see growHarvestPatch).
+    If you propagate the same prescription from many stands, compute
+    eligibleStands once with eligibleStandsForPrescription and give it here.
+    If standScores is given, the best neighbours are harvested first.
     Returns a list of harvested stands.
     """
-    listOfHarvestedStands = list()
-    frontier = [standID]
-    surfaceHarvested = 0
-    while surfaceHarvested < prescriptionParameters[prescription]["HarvestPropagation"][1] and len(frontier) > 0:
-        focusStand = frontier.pop(0)
-        # If we overeach the maximum surface, we stop here.
-        if surfaceHarvested + len(standCoordinatesDict[focusStand]) > prescriptionParameters[prescription]["HarvestPropagation"][1]:
-            break
-        else:
-            listOfHarvestedStands.append(focusStand)
-            # TO UPDATE : Surface harvested here is dealt in pixels. But in harvest parameter
-            # file, might be in different units than pixel. See how to adapt to that. Need cell length ?
-            surfaceHarvested += len(standCoordinatesDict[standID])
-            for neighbor in standNeighboursDict[focusStand] :
-                if neighbor not in listOfHarvestedStands and standAgeDict[neighbor] > prescriptionParameters[prescription]["MinimumStandAge"] and standAgeDict[neighbor] < prescriptionParameters[prescription]["MaximumStandAge"]:
-                   frontier.append(neighbor) 
-    return(listOfHarvestedStands)
+    if eligibleStands is None:
+        eligibleStands = eligibleStandsForPrescription(prescription,
+                                                       prescriptionParameters,
+                                                       standCoordinatesDict,
+                                                       standAgeDict)
+    minimumPatchSize, maximumPatchSize = prescriptionParameters[prescription]["HarvestPropagation"]
+    standsOfPatch, patchSize = growHarvestPatch(standID,
+                                                minimumPatchSize,
+                                                maximumPatchSize,
+                                                standNeighboursDict,
+                                                standCoordinatesDict,
+                                                eligibleStands,
+                                                standScores)
+    return(standsOfPatch.tolist())
+
+class HarvestParameterFileTemplate:
+    """
+    Template harvest parameter file, read once and split around the places
+    that Magic Harvest edits at each timestep :
+    - the "ManagementAreas" line, replaced by the path of the prescription map;
+    - the table of HarvestImplementations, where a line is added for each
+      prescription applied this timestep (2 lines under its header);
+    - the ">> PASTE_PLANTING_HERE" line, before which the planting
+      prescriptions are pasted.
+    render() then makes the text of the file for a timestep in one pass.
+    """
+    implementationsHeader = ">> Mgmt Area Prescription   Harvest Area   Begin Time   End Time"
+    plantingAnchor = ">> PASTE_PLANTING_HERE"
+    
+    def __init__(self, path):
+        with open(path, 'r') as file:
+            self.lines = file.readlines()
+        self.managementAreasLine = None
+        self.implementationsLine = None
+        self.plantingLine = None
+        for lineNumber, line in enumerate(self.lines):
+            strippedLine = line.strip()
+            if self.managementAreasLine is None and line.split()[:1] == ["ManagementAreas"]:
+                self.managementAreasLine = lineNumber
+            elif strippedLine == self.implementationsHeader:
+                self.implementationsLine = lineNumber + 2
+            elif strippedLine == self.plantingAnchor:
+                self.plantingLine = lineNumber
+        if self.managementAreasLine is None or self.implementationsLine is None:
+            raise ValueError("Could not find the ManagementAreas line or the line \"" + self.implementationsHeader + "\" in the template harvest parameter file " + path)
+    
+    def render(self, managementMapName, implementationLines, plantingLines):
+        """Returns the text of the harvest parameter file with the given
+        prescription map, implementation lines and planting lines."""
+        if len(plantingLines) > 0 and self.plantingLine is None:
+            raise ValueError("Could not find the line \"" + self.plantingAnchor + "\" in the template harvest parameter file, where the planting prescriptions are pasted.")
+        # We list what goes where, and then go through the template once
+        edits = [(self.managementAreasLine, 0, ["ManagementAreas \"" + managementMapName + "\"\n"], 1),
+                 (self.implementationsLine, 1, implementationLines, 0)]
+        if len(plantingLines) > 0:
+            edits.append((self.plantingLine, 2, plantingLines, 0))
+        edits.sort()
+        chunks = list()
+        currentLine = 0
+        for lineNumber, order, linesToWrite, numberOfLinesReplaced in edits:
+            chunks.extend(self.lines[currentLine:lineNumber])
+            chunks.extend(linesToWrite)
+            currentLine = lineNumber + numberOfLinesReplaced
+        chunks.extend(self.lines[currentLine:])
+        return("".join(chunks))
+
+# Templates of harvest parameter files already read, by path
+# (see getHarvestParameterFileTemplate)
+harvestParameterFileTemplates = dict()
+
+def getHarvestParameterFileTemplate(path):
+    """Returns the HarvestParameterFileTemplate of the file at the given path,
+    reading it only if it was not already read or has changed since."""
+    modificationTime = os.stat(path).st_mtime_ns
+    if path not in harvestParameterFileTemplates or harvestParameterFileTemplates[path][0] != modificationTime:
+        harvestParameterFileTemplates[path] = (modificationTime, HarvestParameterFileTemplate(path))
+    return(harvestParameterFileTemplates[path][1])
+
+def writeTextFileAtomically(path, text, newline = None):
+    """Writes the text in a temporary file that then replaces the file at the
+    given path, so that the file is never seen half-written."""
+    temporaryPath = path + "-" + str(os.getpid()) + ".tmp"
+    with open(temporaryPath, 'w', newline = newline) as file:
+        file.write(text)
+    os.replace(temporaryPath, path)
 
 def writeHarvestParameterFile(managementMap,
                               folderWithDHarvestata,
@@ -530,15 +1977,9 @@ def writeHarvestParameterFile(managementMap,
     # We get all of the unique prescription ID put in the map this timestep
     uniquePrescriptionsForTimestep = np.unique(managementMap)
     # We remove 0 from the prescriptions, as it's only indicative of no prescription
-    uniquePrescriptionsForTimestep = np.delete(uniquePrescriptionsForTimestep, np.where(uniquePrescriptionsForTimestep == 0))
-    # For each prescription, we write in the harvest.txt parameter file.
-    # Whatever the timestep, we reset the harvest.txt file to the initial one, to fill
-    # it up again.
-    shutil.copyfile((os.getcwd() + folderWithDHarvestata + templateHarvestFileName),
-                    (os.getcwd() + folderWithDHarvestata + realHarvestFileName))
-    # We read the text of the parameter file
-    BioHarvestParameterFile = open((os.getcwd() + folderWithDHarvestata + realHarvestFileName),'r')
-    BioHarvestParameterFileText = BioHarvestParameterFile.readlines()
+    uniquePrescriptionsForTimestep = uniquePrescriptionsForTimestep[uniquePrescriptionsForTimestep != 0]
+    # Whatever the timestep, we start again from the template file to fill it up.
+    harvestFileTemplate = getHarvestParameterFileTemplate(os.getcwd() + folderWithDHarvestata + templateHarvestFileName)
     
     # We prepare the lines that we will write to force the harvesting where we want it
     # We just create a dict to find the right prescription name for the ID in the map
@@ -549,44 +1990,30 @@ def writeHarvestParameterFile(managementMap,
     if "PlantingPrescriptions" in prescriptionParameters:
         for plantingPrescription in prescriptionParameters["PlantingPrescriptions"]:
             prescriptionsNameDict[prescriptionParameters["PlantingPrescriptions"][plantingPrescription]["PrescriptionID"]] = plantingPrescription
-    # Now we insert the lines
-    linesToInsert = list()
-    for prescriptionID in uniquePrescriptionsForTimestep:
-        linesToInsert.append("\t" + str(prescriptionID) +
-                             "\t\t" + str(prescriptionsNameDict[prescriptionID]) +
-                             "\t\t100%\t\t" +
-                             str(timestep) + "\t" + str(timestep) + "\n")
-    # We detect where we will write
-    insertionLine = BioHarvestParameterFileText.index(">> Mgmt Area Prescription   Harvest Area   Begin Time   End Time\n") + 2
-    # We reverse the list to keep the same order of writing in the final file
-    linesToInsert.reverse()
-    # We write the lines
-    for line in linesToInsert:
-        BioHarvestParameterFileText.insert(insertionLine, line)
+    implementationLines = list()
+    for prescriptionID in uniquePrescriptionsForTimestep.tolist():
+        implementationLines.append("\t" + str(prescriptionID) +
+                                   "\t\t" + str(prescriptionsNameDict[prescriptionID]) +
+                                   "\t\t100%\t\t" +
+                                   str(timestep) + "\t" + str(timestep) + "\n")
         
     # We also write the lines with the plantation prescriptions
+    plantingLines = list()
     if "PlantingPrescriptions" in prescriptionParameters: 
-        linesToInsert = list()
         for prescription in prescriptionParameters["PlantingPrescriptions"]:
-            linesToInsert.extend(prescriptionParameters["PlantingPrescriptions"][prescription]["FullString"])
-            linesToInsert.append("\n\n")
-        insertionLine = BioHarvestParameterFileText.index(">> PASTE_PLANTING_HERE\n")
-        linesToInsert.reverse()
-        for line in linesToInsert:
-            BioHarvestParameterFileText.insert(insertionLine, line)
-    
-    # We finish by changing the name of the maps that we will give to Biomass harvest
-    lineToChange = BioHarvestParameterFileText.index("ManagementAreas \"../../sharedRasters/management_areas_v1.0.tif\"\n")
-    # We replace it
-    BioHarvestParameterFileText[lineToChange] = "ManagementAreas \"" + managementMapName + "\"\n"
-    # We also replace the name of the stand map
-    # Actually, it causes errors with the system of partial stand spread ? To delete if resolved.
-    # lineToChange = BioHarvestParameterFileText.index("Stands \"../../sharedRasters/stands_v2.0.tif\"\n")
-    # BioHarvestParameterFileText[lineToChange] = "Stands \"" + managementMapName + "\"\n"
+            plantingLines.extend(prescriptionParameters["PlantingPrescriptions"][prescription]["FullString"])
+            plantingLines.append("\n\n")
+    
+    # We also change the name of the map that we will give to Biomass harvest.
+    # (The stand map is not replaced, as it seems to cause errors with the
+    # system of partial stand spread.)
     # We save the parameter file
-    BioHarvestParameterFile = open((os.getcwd() + folderWithDHarvestata + realHarvestFileName), "w")
-    BioHarvestParameterFileText = "".join(BioHarvestParameterFileText)
-    BioHarvestParameterFile.write(BioHarvestParameterFileText)
+    harvestFileText = harvestFileTemplate.render(managementMapName,
+                                                 implementationLines,
+                                                 plantingLines)
+    # (It contains the timestep, so it changes at each timestep and is
+    # always written.)
+    writeTextFileAtomically(os.getcwd() + folderWithDHarvestata + realHarvestFileName, harvestFileText)
 
 def WriteTableOfPrescriptionsID(pathToTable,
                                 prescriptionParameters):
@@ -614,18 +2041,253 @@ def WriteTableOfPrescriptionsID(pathToTable,
         listOfOuputs.append([prescriptionsNameDict[prescriptionID], prescriptionID+1])
     
     # We write what we need for the .csv file
-    with open(pathToTable, 'w+', newline='') as file:
-        writer = csv.writer(file)
+    tableText = io.StringIO(newline='')
+    writer = csv.writer(tableText)
+    writer.writerows(listOfOuputs)
+    writeTextFileAtomically(pathToTable, tableText.getvalue(), newline='')
+    
+def serveTimesteps(socketPath):
+    """Makes this process a warm worker waiting for timesteps sent by
+    sendRequestToWarmWorker on the Unix socket at socketPath.
+    Each timestep is dealt with in a copy of this process made with os.fork,
+    which keeps all of the data already read in memory. This function only
+    returns in the copy, giving it the timestep to deal with; the copy then
+    runs the rest of the script and exits.
+    The worker itself stops when it receives "stop"."""
+    serverPID = os.getpid()
+    if not os.path.exists(os.path.dirname(socketPath)):
+        os.makedirs(os.path.dirname(socketPath))
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketPath)
+    server.listen(1)
+    print("Magic harvest warm worker : waiting for timesteps at " + socketPath)
+    try:
+        while True:
+            connection, address = server.accept()
+            request, requestFolder = connection.makefile("r").readline().rstrip("\n").split("\t")
+            if request == "stop":
+                connection.sendall((warmWorkerExitMarker + " 0\n").encode())
+                connection.close()
+                break
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                # In the copy, everything that is printed goes to the client
+                server.close()
+                os.dup2(connection.fileno(), sys.stdout.fileno())
+                os.dup2(connection.fileno(), sys.stderr.fileno())
+                connection.close()
+                os.chdir(requestFolder)
+                return(int(request))
+            pid, status = os.waitpid(pid, 0)
+            connection.sendall(("\n" + warmWorkerExitMarker + " " + str(os.waitstatus_to_exitcode(status)) + "\n").encode())
+            connection.close()
+    finally:
+        if os.getpid() == serverPID:
+            server.close()
+            if os.path.exists(socketPath):
+                os.remove(socketPath)
+    print("Magic harvest warm worker : stopped.")
+    sys.exit(0)
+
+def hashFilesAndParameters(listOfPaths, parameters, cacheFolder = None):
+    """Returns a hash of the content of the files at the given paths and
+    of a dictionnary of parameters. Used to know if the cache of static
+    data is still valid.
+    If cacheFolder is given, the hash of the files is kept there along with
+    their path, size and modification time; the files are then only read
+    again when one of these changes."""
+    listOfPaths = [os.path.abspath(path) for path in listOfPaths]
+    fileSignature = [[os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in listOfPaths]
+    filesKey = json.dumps(listOfPaths)
+    fileHashes = dict()
+    fileHashesPath = None
+    if cacheFolder is not None:
+        fileHashesPath = os.path.join(cacheFolder, "fileHashes.json")
+        if os.path.exists(fileHashesPath):
+            with open(fileHashesPath, 'r') as file:
+                fileHashes = json.load(file)
+    
+    if filesKey in fileHashes and fileHashes[filesKey]["signature"] == fileSignature:
+        filesHash = fileHashes[filesKey]["hash"]
+    else:
+        hasher = hashlib.blake2b(digest_size = 16)
+        for path in listOfPaths:
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(2**24), b""):
+                    hasher.update(chunk)
+        filesHash = hasher.hexdigest()
+        if fileHashesPath is not None:
+            if not os.path.exists(cacheFolder):
+                os.makedirs(cacheFolder)
+            fileHashes[filesKey] = {"signature": fileSignature, "hash": filesHash}
+            writeTextFileAtomically(fileHashesPath, json.dumps(fileHashes, indent = 1))
+    
+    hasher = hashlib.blake2b(digest_size = 16)
+    hasher.update(filesHash.encode())
+    hasher.update(json.dumps(parameters, sort_keys = True).encode())
+    return(hasher.hexdigest())
+
+def loadStaticStandCache(cacheFolder, cacheKey):
+    """Loads the arrays saved by saveStaticStandCache for the given key.
+    The arrays are memory-mapped, so this takes a few milliseconds whatever
+    the size of the landscape. Returns None if there is no cache for this key
+    (e.g. because one of the input rasters changed)."""
+    cachePath = os.path.join(cacheFolder, "staticStandCache-" + cacheKey)
+    if not os.path.isdir(cachePath):
+        return(None)
+    print("Loading cached static stand data...")
+    dictOfArrays = dict()
+    for fileName in os.listdir(cachePath):
+        dictOfArrays[fileName[:-len(".npy")]] = np.load(os.path.join(cachePath, fileName), mmap_mode = "r")
+    return(dictOfArrays)
+
+def saveStaticStandCache(cacheFolder, cacheKey, dictOfArrays):
+    """Saves a dictionnary of numpy arrays as .npy files in a folder named
+    after the key, and removes the caches made for other keys (they
+    correspond to input rasters that are not used anymore)."""
+    print("Saving static stand data in cache...")
+    if not os.path.exists(cacheFolder):
+        os.makedirs(cacheFolder)
+    cachePath = os.path.join(cacheFolder, "staticStandCache-" + cacheKey)
+    for folderName in os.listdir(cacheFolder):
+        # (the .tmp folders are being written by other processes, e.g. replicates)
+        if (folderName.startswith("staticStandCache-") and not folderName.endswith(".tmp")
+            and folderName != os.path.basename(cachePath)):
+            shutil.rmtree(os.path.join(cacheFolder, folderName), ignore_errors = True)
+    # We write in a temporary folder first, so that an interrupted run
+    # can't leave an incomplete cache behind.
+    temporaryCachePath = cachePath + "-" + str(os.getpid()) + ".tmp"
+    os.makedirs(temporaryCachePath)
+    for arrayName in dictOfArrays:
+        np.save(os.path.join(temporaryCachePath, arrayName + ".npy"), dictOfArrays[arrayName])
+    try:
+        os.rename(temporaryCachePath, cachePath)
+    except OSError:
+        # Another process saved the same cache in the meantime; we keep theirs
+        shutil.rmtree(temporaryCachePath, ignore_errors = True)
+        if not os.path.isdir(cachePath):
+            raise
+
+def readingStaticStandData(standMapPath,
+                           managementUnitsMapPath,
+                           cacheFolder,
+                           disableTQDM,
+                           readByBlocks = False):
+    """Returns the stand index, the management unit of each stand and the
+    neighbors of each stand. These only depend on the stands and management
+    units rasters, which don't change during a simulation; so they are saved
+    in a cache in cacheFolder the first time, and then loaded from it
+    as long as the content of the rasters stays the same (the rasters are
+    only hashed again if their size or modification time change, see
+    hashFilesAndParameters).
+    The rasters are only read if there is no cache for them; both are then
+    read at the same time (see loadInputsInParallel), or by blocks if
+    readByBlocks is True (see iterateRasterBlocks)."""
+    cacheKey = hashFilesAndParameters([standMapPath, managementUnitsMapPath],
+                                      {"cacheVersion": 4},
+                                      cacheFolder)
+    cache = loadStaticStandCache(cacheFolder, cacheKey)
+    if cache is not None:
+        standCoordinatesDict = StandIndex.fromArrays(cache["shape"],
+                                                     cache["pixelIndices"],
+                                                     cache["standIDs"],
+                                                     cache["sizes"],
+                                                     standMapPath)
+        standUADict = dict(zip(cache["standIDs"].tolist(), cache["managementUnits"].tolist()))
+        standNeighboursDict = StandAdjacency(cache["standIDs"],
+                                             cache["neighboursOffsets"],
+                                             cache["neighbourIDs"],
+                                             cache["boundaryLengths"])
+        return(standCoordinatesDict, standUADict, standNeighboursDict)
+    
+    if readByBlocks:
+        standRasterData = standMapPath
+    else:
+        staticInputs = loadInputsInParallel({"stands": (rasterStore.get, standMapPath, rasterDataTypes["stands"]),
+                                             "managementUnits": (rasterStore.get, managementUnitsMapPath, rasterDataTypes["managementUnits"])})
+        standRasterData = staticInputs["stands"].result()
+        # The management units raster is then taken from rasterStore
+        staticInputs["managementUnits"].result()
+    standCoordinatesDict = readingStandsCoordinates(standRasterData,
+                                                    disableTQDM)
+    standCoordinatesDict.rasterPath = standMapPath
+    standUADict = readingStandManagementUnit(standCoordinatesDict,
+                                             managementUnitsMapPath,
+                                             disableTQDM,
+                                             readByBlocks)
+    standNeighboursDict = readingStandsNeighbors(standRasterData,
+                                                 standCoordinatesDict,
+                                                 disableTQDM)
+    # The rasters are not needed anymore (the stand index and the dictionnaries
+    # above replace them), so we don't keep them in memory until the end of the
+    # run or for the life of the warm worker.
+    del standRasterData
+    rasterStore.remove(standMapPath, rasterDataTypes["stands"])
+    rasterStore.remove(managementUnitsMapPath, rasterDataTypes["managementUnits"])
     
-        # Write the data to the CSV file
-        writer.writerows(listOfOuputs)
+    saveStaticStandCache(cacheFolder, cacheKey,
+                         {"shape": np.array(standCoordinatesDict.shape),
+                          "pixelIndices": standCoordinatesDict.pixelIndices,
+                          "standIDs": standCoordinatesDict.standIDs,
+                          "sizes": standCoordinatesDict.sizes,
+                          "managementUnits": np.array([standUADict[standID] for standID in standCoordinatesDict.standIDs.tolist()]),
+                          "neighboursOffsets": standNeighboursDict.offsets,
+                          "neighbourIDs": standNeighboursDict.neighbourIDs,
+                          "boundaryLengths": standNeighboursDict.boundaryLengths})
+    return(standCoordinatesDict, standUADict, standNeighboursDict)
+
+def readingHarvestParameterFile(harvestParameterFilePath, speciesList, cacheFolder):
+    """Returns the parameters of the prescriptions and the timestep length
+    read in the harvest parameter file (see harvestParameterFileParser).
+    The template file doesn't change during a simulation, so the result is
+    pickled in cacheFolder the first time; the next time steps (and the
+    replicates using the same cache folder) just load it back, as long as
+    the path, size and modification time of the file and the species list
+    stay the same."""
+    harvestParameterFilePath = os.path.abspath(harvestParameterFilePath)
+    fileStatus = os.stat(harvestParameterFilePath)
+    # The first part of the name identifies the file, the second its version
+    cachePrefix = "harvestParametersCache-" + hashlib.blake2b(harvestParameterFilePath.encode(), digest_size = 8).hexdigest() + "-"
+    cacheKey = hashlib.blake2b(json.dumps({"size": fileStatus.st_size,
+                                           "mtime": fileStatus.st_mtime_ns,
+                                           "speciesList": list(speciesList),
+                                           "cacheVersion": 2}, sort_keys = True).encode(),
+                               digest_size = 16).hexdigest()
+    cachePath = os.path.join(cacheFolder, cachePrefix + cacheKey + ".pickle")
+    if os.path.exists(cachePath):
+        with open(cachePath, "rb") as cacheFile:
+            return(pickle.load(cacheFile))
     
+    prescriptionParameters, timestepLength = harvestParameterFileParser(harvestParameterFilePath,
+                                                                        speciesList)
+    
+    if not os.path.exists(cacheFolder):
+        os.makedirs(cacheFolder)
+    for fileName in os.listdir(cacheFolder):
+        # (the .tmp files are being written by other processes)
+        if fileName.startswith(cachePrefix) and not fileName.endswith(".tmp"):
+            os.remove(os.path.join(cacheFolder, fileName))
+    # We write in a temporary file first, so that another process never
+    # reads an incomplete cache.
+    temporaryCachePath = cachePath + "-" + str(os.getpid()) + ".tmp"
+    with open(temporaryCachePath, "wb") as cacheFile:
+        pickle.dump((prescriptionParameters, timestepLength), cacheFile, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(temporaryCachePath, cachePath)
+    return(prescriptionParameters, timestepLength)
+
 #%% DEBUG
 
 # Just put "False" unless you're tinkering with this script.
 debug = False
 # debug = True
 
+# Are we launching the warm worker ? (see the top of the script)
+serverMode = False
+
 # If debugging, we prepare a dummy situation
 if debug:
     os.chdir(r"path/to/your/folder/with/simulation/files/landis-ii")
@@ -640,8 +2302,11 @@ else:
     if __name__ == "__main__":
         # Remember : argument at index 0 contains the program name.
         # The arguments that we want come after
-        timestep = sys.argv[1]
-        timestep = int(timestep)
+        if sys.argv[1] == "serve":
+            serverMode = True
+        else:
+            timestep = sys.argv[1]
+            timestep = int(timestep)
         # You can retrieve other arguments here; just use sys.argv[2], sys.argv[3], etc. 
     # We disable the progress bars of TQDM to not display them in the LANDIS log
     disableTQDM = True
@@ -649,57 +2314,102 @@ else:
 # Should you remove the community files made at each time step ? (they are heavy)
 removeCommunitiesFiles = True
 
+# Should the rasters be read by blocks rather than all at once ? Use it if your
+# landscape is too big for the rasters to fit in memory (it's a bit slower).
+readRastersByBlocks = False
+
 #%% DEFINING PARAMETERS FOR EACH PRESCRIPTION
 
+# We read the species used in LANDIS-II. Replace the path by the one of your
+# species input file !
+speciesList = readSpeciesList("./input/species.txt")
+
 # We read the template harvest parameter file, which also contains the parameters needed
-# for magic harvest
-prescriptionParameters, timestepLength = harvestParameterFileParser("./input/disturbances/harvesting/harvest_BAU_v2.0_TEMPLATE.txt")
+# for magic harvest. The result is cached in the temporary folder of Magic Harvest,
+# and the file is only parsed again if it changes.
+prescriptionParameters, timestepLength = readingHarvestParameterFile("./input/disturbances/harvesting/harvest_BAU_v2.0_TEMPLATE.txt",
+                                                                     speciesList,
+                                                                     "./input/disturbances/harvesting/tempMagicHarvest/")
+
+#%% READING STATIC DATA
+
+# Reading the stand coordinates, the management units (UAs) of the stands
+# and the stand neighbors dict (used for stand propagation).
+# They are cached in the temporary folder of Magic Harvest, and the stands
+# and management units rasters are only read again if they change.
+standCoordinatesDict, standUADict, standNeighboursDict = readingStaticStandData("../../sharedRasters/stands_v2.0.tif",
+                                                                                "../../sharedRasters/rasterUAInterpolated.tif",
+                                                                                "./input/disturbances/harvesting/tempMagicHarvest/",
+                                                                                disableTQDM,
+                                                                                readRastersByBlocks)
+
+#%% WARM WORKER (SERVER MODE)
+
+# In server mode, the static data read above stays in memory, and we wait for
+# the timesteps sent by Magic Harvest. Each of them is dealt with by a copy of
+# this process that runs the rest of the script.
+if serverMode:
+    timestep = serveTimesteps(warmWorkerSocketPath)
 
 #%% READING DATA FOR TIME STEP
 
-# Reading files for stand coordinates
-standRasterData = getRasterData("../../sharedRasters/stands_v2.0.tif")
-standCoordinatesDict = readingStandsCoordinates(standRasterData,
-                                                disableTQDM)
-
-# Reading raster of Management units (UAs)
-standUADict = readingStandManagementUnit("../../sharedRasters/stands_v2.0.tif",
-                                         "../../sharedRasters/rasterUAInterpolated.tif",
-                                         disableTQDM)
-
-# Reading JSON files for repeated prescriptions
-repeatPrescriptionPath = "./input/disturbances/harvesting/temp/repeatedPrescriptions.pickle"
-if os.path.exists("repeatPrescriptionPath"):
-    with open(repeatPrescriptionPath) as repeatedPrescriptionFile:
-        pickle.load(repeatPrescriptionsDict, repeatedPrescriptionFile)
+# We start reading the maps and csv of the timestep at the same time
+# (see loadInputsInParallel), and wait for them where they're needed below.
+communityCsvPath = "./community-input-file-" + str(timestep- timestepLength) + ".csv"
+communityMapPath = "./output-community-" + str(timestep- timestepLength) + ".img"
+cohortMaxAgeMapPath = "./output/cohort-stats/AGE-MAX-" + str(timestep - timestepLength) + ".img"
+if readRastersByBlocks:
+    timestepInputs = loadInputsInParallel({"communityCsv": (readCommunityCsv, communityCsvPath)})
 else:
-    repeatPrescriptionsDict = "noRepeatsForNow"
+    timestepInputs = loadInputsInParallel({"communityCsv": (readCommunityCsv, communityCsvPath),
+                                           "communityMap": (getRasterData, communityMapPath, rasterDataTypes["mapcodes"]),
+                                           "cohortMaxAges": (getRasterData, cohortMaxAgeMapPath, rasterDataTypes["ages"])})
+
+# Reading the stands that are due for a repeated prescription (SingleRepeat or
+# MultipleRepeat) at this timestep. At the first timestep, we remove the ones
+# of a previous simulation.
+repeatedPrescriptionSchedule = RepeatedPrescriptionSchedule("./input/disturbances/harvesting/tempMagicHarvest/repeatedPrescriptions/")
+if timestep == timestepLength:
+    repeatedPrescriptionSchedule.clear()
+dueRepeatStandIDs, dueRepeatPrescriptionIDs = repeatedPrescriptionSchedule.due(timestep)
+# The ones of the MultipleRepeat prescriptions are applied again as is (see below)
+dueMultipleRepeatStandIDs, dueMultipleRepeatPrescriptionIDs = repeatedPrescriptionSchedule.due(timestep,
+                                                                                               prescriptionParameters,
+                                                                                               repeatModes = ("MultipleRepeat",))
+
+# Counting the pixels of each vegetation community (mapcode) in each stand.
+# You can use this matrix with aggregateMapCodeValuesToStands to compute
+# your own stand-level metrics from the community csv.
+standMapCodeMatrix = readingStandMapCodeCounts(standCoordinatesDict,
+                                               communityMapPath if readRastersByBlocks else timestepInputs["communityMap"].result())
 
 # Reading vegetation communities
-standCompositionDict = readCommunitiesComplete("./community-input-file-" + str(timestep- timestepLength) + ".csv",
-                                            "./output-community-" + str(timestep- timestepLength) + ".img",
+standCompositionDict = readCommunitiesComplete(communityCsvPath,
+                                            communityMapPath,
                                             standCoordinatesDict,
-                                            disableTQDM)
+                                            disableTQDM,
+                                            standMapCodeMatrix,
+                                            timestepInputs["communityCsv"].result())
 
 # Reading stand ages
-standAgeDict = readingStandsAges("../../sharedRasters/stands_v2.0.tif",
+standAgeDict = readingStandsAges(standCoordinatesDict,
                          "./output/cohort-stats/",
                          timestep,
                          timestepLength,
-                         disableTQDM)
+                         disableTQDM,
+                         readRastersByBlocks,
+                         None if readRastersByBlocks else timestepInputs["cohortMaxAges"].result())
 
 # Determining forest types
 forestTypesStandsDict = DetermineForestTypesOfStands(standCompositionDict,
                                                      standCoordinatesDict,
                                                      disableTQDM)
 
-# Determining management unit for each stand (used for the conversion of
-# raw to net merchantable volume harvested)
-
-# stand neighbors dict (used for stand propagation)
-standNeighboursDict = readingStandsNeighbors(standRasterData,
-                                            standCoordinatesDict,
-                                            disableTQDM)
+# Computing the biomass that each prescription would remove from each stand
+# (one row per stand of standCoordinatesDict.standIDs, one column per prescription)
+removableBiomass, removableBiomassPrescriptions = computeRemovableBiomass(standCompositionDict,
+                                                                          standCoordinatesDict,
+                                                                          prescriptionParameters)
 
 # Removing vegetation communities files if needed
 if not debug and removeCommunitiesFiles:
@@ -713,7 +2423,9 @@ if not debug and removeCommunitiesFiles:
 #%% PREPARING OTHER OBJECTS WE NEED
 
 # We prepare the empty management map that we will fill with the values of the pixels where we want to harvest.
-managementMap = np.zeros_like(getRasterData("../../sharedRasters/stands_v2.0.tif"))
+# It has the size of the stands raster, and the data type used to write it (int16).
+standRasterProfile = getRasterProfile("../../sharedRasters/stands_v2.0.tif")
+managementMap = np.zeros((standRasterProfile.rows, standRasterProfile.columns), dtype = np.int16)
 
 
 
@@ -724,6 +2436,95 @@ managementMap = np.zeros_like(getRasterData("../../sharedRasters/stands_v2.0.tif
 # So, doing your repeated prescriptions, ranking the stands and then applying new prescriptions until you 
 # reach a given target, etc., etc.
 
+# The stands due for a MultipleRepeat prescription are harvested again with it,
+# and scheduled for the next repeat.
+for prescriptionID in np.unique(dueMultipleRepeatPrescriptionIDs).tolist():
+    managementMap, numberOfPixelsHarvested = harvestStandPositions(managementMap,
+                                                                   standCoordinatesDict.positionsOf(dueMultipleRepeatStandIDs[dueMultipleRepeatPrescriptionIDs == prescriptionID]),
+                                                                   standCoordinatesDict,
+                                                                   prescriptionID)
+repeatedPrescriptionSchedule.scheduleRepeats(dueMultipleRepeatStandIDs,
+                                             dueMultipleRepeatPrescriptionIDs,
+                                             timestep,
+                                             prescriptionParameters,
+                                             repeatModes = ("MultipleRepeat",))
+# The stands due for the second pass of a SingleRepeat prescription are NOT
+# harvested by default : applying the same prescription ID would redo its first
+# pass. Write the second pass as a prescription of its own in the harvest file
+# (e.g. "ClearCutSecondPass"), and apply it to these stands :
+# dueSingleRepeatStandIDs, dueSingleRepeatPrescriptionIDs = repeatedPrescriptionSchedule.due(timestep,
+#                                                                                            prescriptionParameters,
+#                                                                                            repeatModes = ("SingleRepeat",))
+# managementMap, numberOfPixelsHarvested = harvestStandPositions(managementMap,
+#                                                                standCoordinatesDict.positionsOf(dueSingleRepeatStandIDs[dueSingleRepeatPrescriptionIDs == prescriptionParameters["ClearCut"]["PrescriptionID"]]),
+#                                                                standCoordinatesDict,
+#                                                                prescriptionParameters["ClearCutSecondPass"]["PrescriptionID"])
+# All of the due stands can't be used by the other prescriptions (see the
+# takenStands argument of allocateTargets)
+repeatedStands = np.isin(standCoordinatesDict.standIDs, dueRepeatStandIDs)
+
+# For salvage logging, we read the disturbances of the last timestep, and the
+# stands with at least half of their surface disturbed can be given a salvage
+# prescription. Replace the paths by the severity maps of your disturbance
+# extensions; for BDA, they are named like "./bda/severity-" + agentName + "-" + timestep + ".img".
+# disturbanceSeverityDict = readingStandsDisturbanceSeverity(standCoordinatesDict,
+#                                                            ["./fire/severity-" + str(timestep - timestepLength) + ".img",
+#                                                             "./wind/severity-" + str(timestep - timestepLength) + ".img"],
+#                                                            readRastersByBlocks)
+# managementMap, salvagedPositions = salvageStands(managementMap,
+#                                                  standCoordinatesDict,
+#                                                  disturbanceSeverityDict,
+#                                                  prescriptionParameters["Salvage"]["PrescriptionID"],
+#                                                  minimumAffectedFraction = 0.5,
+#                                                  takenStands = repeatedStands)
+
+# For example, to harvest 5000 Mg of biomass, 70% of it with "ClearCut" and 30% with
+# "PartialCut", without taking more than 2000 Mg in each management unit, and by
+# harvesting the oldest stands first :
+# standAges = np.array([standAgeDict[standID] for standID in standCoordinatesDict.standIDs.tolist()])
+# standUAs = np.array([standUADict[standID] for standID in standCoordinatesDict.standIDs.tolist()])
+# eligibleStands = np.stack([eligibleStandsForPrescription(prescription, prescriptionParameters, standCoordinatesDict, standAgeDict)
+#                            if prescription in ["ClearCut", "PartialCut"] else np.zeros(len(standCoordinatesDict), dtype = bool)
+#                            for prescription in removableBiomassPrescriptions], axis = 1)
+# # Protected areas can be excluded with eligibleStands[protectedStands, :] = False
+# eligibleStands[repeatedStands, :] = False
+# listOfConstraints = [{"prescriptions": ["ClearCut"], "contributions": removableBiomass, "minimum": 0.7 * 5000},
+#                      {"prescriptions": ["PartialCut"], "contributions": removableBiomass, "minimum": 0.3 * 5000}]
+# for managementUnit in np.unique(standUAs).tolist():
+#     listOfConstraints.append({"stands": standUAs == managementUnit, "contributions": removableBiomass, "maximum": 2000})
+# # The values are negative to harvest just what is needed to reach the targets; the
+# # older the stand, the less it "costs" to harvest it.
+# selectedStandsDict, solverStatus = optimizeStandPrescriptions(np.repeat(standAges.reshape(-1, 1) - standAges.max() - 1, len(removableBiomassPrescriptions), axis = 1),
+#                                                               eligibleStands,
+#                                                               removableBiomassPrescriptions,
+#                                                               listOfConstraints,
+#                                                               timeLimit = 60)
+# If you only need to fill the targets one after the other, allocateTargets does it
+# faster, with a greedy selection of the stands :
+# selectedStandsDict, amountReachedDict = allocateTargets([{"prescription": "ClearCut",
+#                                                           "scores": standAges,
+#                                                           "eligible": eligibleStands[:, removableBiomassPrescriptions.index("ClearCut")],
+#                                                           "contributions": removableBiomass[:, removableBiomassPrescriptions.index("ClearCut")],
+#                                                           "target": 0.7 * 5000},
+#                                                          {"prescription": "PartialCut",
+#                                                           "scores": standAges,
+#                                                           "eligible": eligibleStands[:, removableBiomassPrescriptions.index("PartialCut")],
+#                                                           "contributions": removableBiomass[:, removableBiomassPrescriptions.index("PartialCut")],
+#                                                           "target": 0.3 * 5000,
+#                                                           "stopAfterTarget": False}],
+#                                                         len(standCoordinatesDict))
+# Then, the selected stands are put in the management map, and the ones harvested
+# with a prescription that repeats are scheduled :
+# for prescription in selectedStandsDict:
+#     managementMap, numberOfPixelsHarvested = harvestStandPositions(managementMap,
+#                                                                    selectedStandsDict[prescription],
+#                                                                    standCoordinatesDict,
+#                                                                    prescriptionParameters[prescription]["PrescriptionID"])
+#     repeatedPrescriptionSchedule.scheduleRepeats(standCoordinatesDict.standIDs[selectedStandsDict[prescription]],
+#                                                  prescriptionParameters[prescription]["PrescriptionID"],
+#                                                  timestep,
+#                                                  prescriptionParameters)
+
 
 
 
@@ -741,12 +2542,8 @@ print("Creating outputs...")
 if not os.path.exists("./input/disturbances/harvesting/tempMagicHarvest/"):
     os.mkdir("./input/disturbances/harvesting/tempMagicHarvest/")
 
-# We save the pickle file with the data for the next repeated harvests
-# Wanted to use JSON, but doesn't work well with the complex dictionnaries I use.
-# WARNING : pickle is not human-readable. It is made to be read by a Python script.
-if repeatPrescriptionsDict!= "noRepeatsForNow":
-    with open('./input/disturbances/harvesting/tempMagicHarvest/repeatedPrescriptions.pickle', "wb+") as outfile:
-        pickle.dump(repeatPrescriptionsDict, outfile)
+# The repeated prescriptions of this timestep have been dealt with
+repeatedPrescriptionSchedule.removeDue(timestep)
 
 # Create harvest maps
 print("Magic harvest Python script : WRITING PRESCRIPTION MAP")